@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
+import itertools
 import logging
+import os
+import time
 import typing
 
 import click
 
-from ambari_docker.config import TEMPLATE_TOOL
-from ambari_docker.image_builder import build_ambari_agent_image, build_ambari_server_image
+from ambari_docker.config import TEMPLATE_TOOL, SUPPORTED_OS, OS_BASE_IMAGES
+from ambari_docker.metrics import METRICS
+from ambari_docker.placement import DataMounts, DockerHost, place_nodes
+from ambari_docker.utils import parse_size
 
 LOG = logging.getLogger("AmbariDocker")
 
@@ -48,6 +53,18 @@ LOGGING_CONFIG = {
         "DockerImageBuilder": {
             "handlers": ["default"]
         },
+        "DownloadCache": {
+            "handlers": ["default"]
+        },
+        "RepoFileResolver": {
+            "handlers": ["default"]
+        },
+        "ClusterLauncher": {
+            "handlers": ["default"]
+        },
+        "YumProxy": {
+            "handlers": ["default"]
+        },
         "ProcessRunner": {
             "handlers": ["subcommand"],
             "level": "DEBUG"
@@ -56,6 +73,10 @@ LOGGING_CONFIG = {
             "handlers": ["dockerfile"],
             "level": "DEBUG"
         },
+        "DockerBuildLogger": {
+            "handlers": ["subcommand"],
+            "level": "DEBUG"
+        },
         '': {
             'level': 'DEBUG'
         }
@@ -63,12 +84,42 @@ LOGGING_CONFIG = {
 
 }
 
+METRICS_OUTPUT = {
+    "default": None,
+    "help": "file to write stage timings and counters to after pipeline finishes",
+    "type": click.Path(dir_okay=False)
+}
+
+METRICS_FORMAT = {
+    "default": "jsonl",
+    "show_default": True,
+    "help": "metrics file format, 'prometheus' produces file for node exporter textfile collector",
+    "type": click.Choice(["jsonl", "prometheus"])
+}
+
+COMPOSE_TEMPLATE = "templates/docker-compose.yml"
+
 IMAGE_SHORT_HELP = "build ambari images"
 COMPOSE_SHORT_HELP = "create compose file"
+UP_SHORT_HELP = "start cluster and wait for agents"
+SNAPSHOT_SHORT_HELP = "commit running cluster to images"
 
 IMAGE_REPOSITORY = {
-    "required": True,
-    "help": "repository to use for image building"
+    "multiple": True,
+    "help": "repository to use for image building, can be used multiple times"
+}
+
+IMAGE_MANIFEST = {
+    "default": None,
+    "help": "file with repositories to build images for, one repository url per line, lines starting with '#' are"
+            " ignored",
+    "type": click.Path(exists=True, dir_okay=False)
+}
+
+IMAGE_OS = {
+    "multiple": True,
+    "help": "build images for this os instead of os from repository url, can be used multiple times",
+    "type": click.Choice(SUPPORTED_OS)
 }
 
 IMAGE_INCLUDE_AGENT = {
@@ -92,6 +143,100 @@ IMAGE_MPACKS = {
     "help": "specify mpack to install, can be used multiple times, prepend path with 'purge+' to install mpack with"
             " purge option"
 }
+IMAGE_WORKERS = {
+    "help": "maximum count of images built in parallel",
+    "show_default": True,
+    "default": 2,
+    "type": click.IntRange(min=1)
+}
+
+IMAGE_BUILD_CACHE = {
+    "default": True,
+    "show_default": True,
+    "help": "skip building image if image with the same Dockerfile, context files and base image already exists"
+}
+
+IMAGE_DOWNLOAD_CACHE_DIR = {
+    "default": None,
+    "help": "directory to cache downloaded mpacks and other remote files in, defaults to"
+            " '~/.cache/ambari-docker/downloads'",
+    "type": click.Path(file_okay=False)
+}
+
+IMAGE_DOWNLOAD_CACHE_SIZE = {
+    "default": "10G",
+    "show_default": True,
+    "help": "maximum download cache size, least recently used files are removed when exceeded",
+    "type": click.STRING
+}
+
+IMAGE_DOWNLOAD_WORKERS = {
+    "default": 4,
+    "show_default": True,
+    "help": "maximum count of parallel downloads",
+    "type": click.IntRange(min=1)
+}
+
+IMAGE_REPO_CACHE_TTL = {
+    "default": 0,
+    "show_default": True,
+    "help": "seconds to keep discovered repo file urls on disk, 0 disables on-disk cache",
+    "type": click.IntRange(min=0)
+}
+
+IMAGE_BUILDKIT = {
+    "default": False,
+    "show_default": True,
+    "is_flag": True,
+    "help": "build images with BuildKit, yum and pip caches are kept between builds"
+}
+
+IMAGE_PULL = {
+    "default": True,
+    "show_default": True,
+    "help": "before build, compare base images with registry and pull changed or missing ones concurrently"
+}
+
+IMAGE_PREWARM_SERVER = {
+    "default": False,
+    "show_default": True,
+    "is_flag": True,
+    "help": "start ambari server once during build, so containers start with initialized database;"
+            " startup time of prewarmed server is measured and saved in image label"
+}
+
+IMAGE_PREWARM_TIMEOUT = {
+    "default": 300,
+    "show_default": True,
+    "help": "seconds to wait for ambari server api during '--prewarm-server' build step",
+    "type": click.IntRange(min=1)
+}
+
+IMAGE_YUM_PROXY = {
+    "default": False,
+    "show_default": True,
+    "help": "download packages of ambari repositories through local caching proxy started for the time of build"
+}
+
+IMAGE_YUM_PROXY_PORT = {
+    "default": 3142,
+    "show_default": True,
+    "help": "port of yum proxy, must be reachable from build containers",
+    "type": click.IntRange(min=1, max=65535)
+}
+
+IMAGE_YUM_CACHE_DIR = {
+    "default": None,
+    "help": "directory to keep packages downloaded by yum proxy in, defaults to '~/.cache/ambari-docker/yum'",
+    "type": click.Path(file_okay=False)
+}
+
+IMAGE_YUM_CACHE_SIZE = {
+    "default": "20G",
+    "show_default": True,
+    "help": "maximum yum proxy cache size, least recently used packages are removed when exceeded",
+    "type": click.STRING
+}
 
 COMPOSE_SUFFIX = {
     "help": "suffix to distinct container names",
@@ -175,6 +320,139 @@ COMPOSE_SERVER_PORT = {
             "specified several times"
 }
 
+COMPOSE_HEALTHCHECKS = {
+    "help": "add health checks, agents are started only after server api is available",
+    "show_default": True,
+    "default": True
+}
+
+COMPOSE_AGENT_WAVE_SIZE = {
+    "help": "start agents in waves of this size, each wave waits for previous one to become healthy,"
+            " 0 starts all agents at once",
+    "show_default": True,
+    "default": 0,
+    "type": click.IntRange(min=0)
+}
+
+COMPOSE_HOSTS = {
+    "default": [],
+    "multiple": True,
+    "help": "docker host in 'name:MEMORY:CPUS' format, nodes are distributed across hosts and one compose file per "
+            "host is written. Option can be specified several times"
+}
+
+COMPOSE_NETWORK_DRIVER = {
+    "help": "driver of network shared by hosts, used with '--host'",
+    "show_default": True,
+    "default": "overlay",
+    "type": click.Choice(["overlay", "macvlan"])
+}
+
+COMPOSE_TMPFS = {
+    "default": [],
+    "multiple": True,
+    "help": "place node directory on tmpfs, in 'PATH[:SIZE]' format, e.g. '/hadoop:4G'; tmpfs usage counts to node"
+            " memory limit. Option can be specified several times"
+}
+
+COMPOSE_DATA_VOLUME = {
+    "default": [],
+    "multiple": True,
+    "help": "place node directory, e.g. '/var/log', on named volume created for every node. Option can be specified"
+            " several times"
+}
+
+COMPOSE_SHARED_STACK_CACHE = {
+    "help": "share agent stack cache of server node with agents through volume mounted read-only on agents",
+    "show_default": True,
+    "is_flag": True,
+    "default": False
+}
+
+UP_WORKERS = {
+    "help": "count of containers started concurrently",
+    "show_default": True,
+    "default": 8,
+    "type": click.IntRange(min=1)
+}
+
+UP_TIMEOUT = {
+    "help": "seconds to wait for all agents to register",
+    "show_default": True,
+    "default": 1800,
+    "type": click.IntRange(min=1)
+}
+
+UP_NODE_TIMEOUT = {
+    "help": "seconds to wait for agent registration after server api became available",
+    "show_default": True,
+    "default": 600,
+    "type": click.IntRange(min=1)
+}
+
+UP_REPLACE = {
+    "help": "remove existing containers of cluster with the same suffix before start",
+    "show_default": True,
+    "is_flag": True,
+    "default": False
+}
+
+UP_AMBARI_USER = {
+    "help": "ambari user for api requests",
+    "show_default": True,
+    "default": "admin"
+}
+
+UP_AMBARI_PASSWORD = {
+    "help": "ambari password for api requests",
+    "show_default": True,
+    "default": "admin"
+}
+
+SNAPSHOT_SUFFIX = {
+    "help": "suffix of cluster to snapshot",
+    "show_default": True,
+    "default": "cl1"
+}
+
+SNAPSHOT_IMAGE_PREFIX = {
+    "help": "prefix of snapshot images, image of every node is named '<prefix>/<suffix>-<node>'",
+    "show_default": True,
+    "default": "crs/ambari-snapshot"
+}
+
+SNAPSHOT_TAG = {
+    "help": "tag of snapshot images, current time by default",
+    "default": None
+}
+
+SNAPSHOT_OUTPUT = {
+    "help": "file path to output compose file that starts cluster from snapshot",
+    "show_default": True,
+    "default": "ambari-snapshot.yml",
+    "type": click.Path()
+}
+
+SNAPSHOT_WORKERS = {
+    "help": "count of containers stopped and committed concurrently",
+    "show_default": True,
+    "default": 8,
+    "type": click.IntRange(min=1)
+}
+
+SNAPSHOT_RESTART = {
+    "help": "start cluster containers again after commit",
+    "show_default": True,
+    "default": True
+}
+
+SNAPSHOT_STOP_TIMEOUT = {
+    "help": "seconds to wait for container to stop before it is killed",
+    "show_default": True,
+    "default": 60,
+    "type": click.IntRange(min=0)
+}
+
 
 class PipelineCommand(object):
     def __init__(self, order, name, callback, **kwargs):
@@ -186,7 +464,9 @@ class PipelineCommand(object):
 
 @click.group(chain=True)
 @click.option('--log-level', type=click.Choice(['INFO', 'DEBUG']), default="INFO", show_default=True)
-def cli(log_level):
+@click.option('--metrics-output', **METRICS_OUTPUT)
+@click.option('--metrics-format', **METRICS_FORMAT)
+def cli(log_level, metrics_output, metrics_format):
     """
     Command line tool to deal with ambari and docker.
 
@@ -206,41 +486,164 @@ def cli(log_level):
 
 
 @cli.resultcallback()
-def process_pipeline(processors, log_level):
+def process_pipeline(processors, log_level, metrics_output, metrics_format):
     previous_command_context = {}
-    for pipeline_command in sorted(processors, key=lambda x: x.order):
-        previous_command_context = pipeline_command.callback(context=previous_command_context, **pipeline_command.args)
-        if not previous_command_context:
-            previous_command_context = {}
+    try:
+        for pipeline_command in sorted(processors, key=lambda x: x.order):
+            with METRICS.span("command", command=pipeline_command.name):
+                previous_command_context = pipeline_command.callback(
+                    context=previous_command_context, **pipeline_command.args
+                )
+            if not previous_command_context:
+                previous_command_context = {}
+    finally:
+        if metrics_output:
+            LOG.info(f"Writing metrics to '{metrics_output}'")
+            METRICS.export(metrics_output, metrics_format)
 
 
 @cli.command(short_help=IMAGE_SHORT_HELP)
-@click.option('-r', '--repository', **IMAGE_REPOSITORY)
+@click.option('-r', '--repository', 'repositories', **IMAGE_REPOSITORY)
+@click.option('--manifest', **IMAGE_MANIFEST)
+@click.option('--os', 'os_list', **IMAGE_OS)
 @click.option('+agent/-agent', 'include_agent', **IMAGE_INCLUDE_AGENT)
 @click.option('-sbi', '--server-base-image', **IMAGE_SERVER_BASE_IMAGE)
 @click.option('-abi', '--agent-base-image', **IMAGE_AGENT_BASE_IMAGE)
 @click.option('-m', '--mpack', **IMAGE_MPACKS)
+@click.option('-w', '--workers', **IMAGE_WORKERS)
+@click.option('--build-cache/--no-build-cache', **IMAGE_BUILD_CACHE)
+@click.option('--download-cache-dir', **IMAGE_DOWNLOAD_CACHE_DIR)
+@click.option('--download-cache-size', **IMAGE_DOWNLOAD_CACHE_SIZE)
+@click.option('--download-workers', **IMAGE_DOWNLOAD_WORKERS)
+@click.option('--repo-cache-ttl', **IMAGE_REPO_CACHE_TTL)
+@click.option('--buildkit', **IMAGE_BUILDKIT)
+@click.option('--pull/--no-pull', **IMAGE_PULL)
+@click.option('--prewarm-server', **IMAGE_PREWARM_SERVER)
+@click.option('--prewarm-timeout', **IMAGE_PREWARM_TIMEOUT)
+@click.option('--yum-proxy/--no-yum-proxy', **IMAGE_YUM_PROXY)
+@click.option('--yum-proxy-port', **IMAGE_YUM_PROXY_PORT)
+@click.option('--yum-cache-dir', **IMAGE_YUM_CACHE_DIR)
+@click.option('--yum-cache-size', **IMAGE_YUM_CACHE_SIZE)
 def image(**kwargs):
     """
     Command to build ambari server and agent docker images.
+
+    Several repositories and os variants can be built in one run, all builds share caches and "--workers" limit.
+    In this case images of the first repository are passed to next command in pipeline.
     """
 
     def callback(
             context: object,
-            repository: str,
+            repositories: typing.List[str],
+            manifest: str,
+            os_list: typing.List[str],
             include_agent: bool,
             server_base_image: str,
             agent_base_image: str,
-            mpack: typing.List[str]
+            mpack: typing.List[str],
+            workers: int,
+            build_cache: bool,
+            download_cache_dir: str,
+            download_cache_size: str,
+            download_workers: int,
+            repo_cache_ttl: int,
+            buildkit: bool,
+            pull: bool,
+            prewarm_server: bool,
+            prewarm_timeout: int,
+            yum_proxy: bool,
+            yum_proxy_port: int,
+            yum_cache_dir: str,
+            yum_cache_size: str
     ):
-        agent_image = build_ambari_agent_image(repository, agent_base_image)
-        server_base_image = agent_image if include_agent else server_base_image
-        server_image = build_ambari_server_image(repository, server_base_image, mpacks=mpack)
-
-        LOG.info(f"Resulting agent image :{agent_image}")
-        LOG.info(f"Resulting server image:{server_image}")
-
-        return {"server_image": server_image, "agent_image": agent_image}
+        # docker, requests and builder modules are loaded only by commands that build images
+        from ambari_docker.downloads import DOWNLOAD_CACHE
+        from ambari_docker.image_builder import build_ambari_agent_image, build_ambari_server_image, BuildScheduler, \
+            repository_for_os, parse_repository_url, prepull_base_images, get_bridge_gateway
+        from ambari_docker.repositories import REPO_FILE_RESOLVER
+        from ambari_docker.yum_proxy import YUM_PROXY
+
+        DOWNLOAD_CACHE.configure(
+            directory=download_cache_dir,
+            max_size=parse_size(download_cache_size),
+            max_workers=download_workers
+        )
+        REPO_FILE_RESOLVER.configure(ttl=repo_cache_ttl)
+
+        repositories = list(repositories)
+        if manifest is not None:
+            with open(manifest) as f:
+                repositories.extend(
+                    line.strip() for line in f if line.strip() and not line.strip().startswith("#")
+                )
+        if not repositories:
+            click.get_current_context().fail("at least one '--repository' or '--manifest' must be specified")
+        if os_list:
+            repositories = [repository_for_os(repository, repo_os) for repository in repositories for repo_os in os_list]
+        repositories = list(dict.fromkeys(repositories))
+        # the same build for several os would produce the same tags otherwise
+        tag_with_os = len({parse_repository_url(repository)[0] for repository in repositories}) > 1
+
+        def build_agent(repository):
+            return lambda _: build_ambari_agent_image(
+                repository, agent_base_image, use_build_cache=build_cache, buildkit=buildkit, tag_with_os=tag_with_os
+            )
+
+        def build_server(repository, agent_task):
+            def build(results):
+                base_image = results[agent_task] if include_agent else server_base_image
+                return build_ambari_server_image(
+                    repository,
+                    base_image,
+                    mpacks=mpack,
+                    use_build_cache=build_cache,
+                    buildkit=buildkit,
+                    tag_with_os=tag_with_os,
+                    prewarm=prewarm_server,
+                    prewarm_timeout=prewarm_timeout
+                )
+
+            return build
+
+        if pull:
+            base_images = []
+            for repository in repositories:
+                default_base_image = OS_BASE_IMAGES[parse_repository_url(repository)[0]]
+                base_images.append(agent_base_image or default_base_image)
+                if not include_agent:
+                    base_images.append(server_base_image or default_base_image)
+            with METRICS.span("prepull"):
+                prepull_base_images(base_images, max_workers=workers)
+
+        scheduler = BuildScheduler(max_workers=workers)
+        for repository in repositories:
+            scheduler.add(f"{repository} agent", build_agent(repository))
+            scheduler.add(
+                f"{repository} server",
+                build_server(repository, f"{repository} agent"),
+                depends_on=(f"{repository} agent",) if include_agent else ()
+            )
+
+        if yum_proxy:
+            YUM_PROXY.configure(directory=yum_cache_dir, max_size=parse_size(yum_cache_size), port=yum_proxy_port)
+            YUM_PROXY.start(get_bridge_gateway())
+        with YUM_PROXY:
+            results = scheduler.run()
+
+        images = [
+            {
+                "repository": repository,
+                "agent_image": results[f"{repository} agent"],
+                "server_image": results[f"{repository} server"]
+            }
+            for repository in repositories
+        ]
+
+        LOG.info("Build summary:")
+        for task_name in scheduler.tasks:
+            LOG.info(f"  {results[task_name]:<60} {scheduler.durations[task_name]:>8.1f}s  {task_name}")
+
+        return {"server_image": images[0]["server_image"], "agent_image": images[0]["agent_image"], "images": images}
 
     return PipelineCommand(0, "image", callback, **kwargs)
 
@@ -258,6 +661,13 @@ def image(**kwargs):
 @click.option("-ai", "--agent-image", **COMPOSE_AGENT_IMAGE)
 @click.option("-sp", "--server-port", "server_ports", **COMPOSE_SERVER_PORT)
 @click.option("--lxcfs", **COMPOSE_LXCFS)
+@click.option("--healthchecks/--no-healthchecks", **COMPOSE_HEALTHCHECKS)
+@click.option("--agent-wave-size", **COMPOSE_AGENT_WAVE_SIZE)
+@click.option("--host", "hosts", **COMPOSE_HOSTS)
+@click.option("--network-driver", **COMPOSE_NETWORK_DRIVER)
+@click.option("--tmpfs", **COMPOSE_TMPFS)
+@click.option("--data-volume", "data_volumes", **COMPOSE_DATA_VOLUME)
+@click.option("--shared-stack-cache", **COMPOSE_SHARED_STACK_CACHE)
 def compose(**kwargs):
     """
     Command to generate docker-compose file based on requested parameters.
@@ -278,7 +688,14 @@ def compose(**kwargs):
             server_image: str,
             agent_image: str,
             server_ports: typing.List[str],
-            lxcfs: bool
+            lxcfs: bool,
+            healthchecks: bool,
+            agent_wave_size: int,
+            hosts: typing.List[str],
+            network_driver: str,
+            tmpfs: typing.List[str],
+            data_volumes: typing.List[str],
+            shared_stack_cache: bool
     ):
         if isinstance(context, dict):
             if agent_image is None:
@@ -290,29 +707,251 @@ def compose(**kwargs):
         if agent_image is None or server_image is None:
             click.get_current_context().fail("'--server-image' and '--agent-image' must be specified")
 
-        nodes = []
-        for i in range(int(node_count)):
-            nodes.append(node_template.format(number=i))
-
-        result = TEMPLATE_TOOL.render(
-            "templates/docker-compose.yml",
-            server_hostname=server_name,
-            domain=network_name,
-            nodes=nodes,
-            server_image=server_image,
-            agent_image=agent_image,
-            suffix=suffix,
-            memory=memory,
-            cpus=cpus,
-            lxcfs=lxcfs,
-            server_ports=server_ports
+        if agent_wave_size and not healthchecks:
+            click.get_current_context().fail("'--agent-wave-size' requires health checks")
+
+        try:
+            mounts = DataMounts(suffix, tmpfs=tmpfs, volumes=data_volumes, shared_stack_cache=shared_stack_cache)
+        except ValueError as e:
+            click.get_current_context().fail(str(e))
+        if shared_stack_cache and hosts:
+            click.get_current_context().fail("'--shared-stack-cache' can not be used with '--host', volumes are local")
+
+        def generate_nodes():
+            # nodes are generated lazily, so compose file for thousands of nodes is written with constant memory
+            for i in range(int(node_count)):
+                depends_on = []
+                if healthchecks:
+                    depends_on.append(server_name)
+                    if agent_wave_size and i >= agent_wave_size:
+                        wave_start = i - i % agent_wave_size
+                        depends_on.extend(
+                            node_template.format(number=j) for j in range(wave_start - agent_wave_size, wave_start)
+                        )
+                yield {"name": node_template.format(number=i), "depends_on": depends_on}
+
+        def write_compose(path, compose_nodes, volume_nodes, **template_arguments):
+            LOG.info(f"Writing compose file to '{path}'")
+            with METRICS.span("template_render", template=COMPOSE_TEMPLATE):
+                TEMPLATE_TOOL.stream(
+                    COMPOSE_TEMPLATE,
+                    server_hostname=server_name,
+                    domain=network_name,
+                    nodes=compose_nodes,
+                    server_image=server_image,
+                    agent_image=agent_image,
+                    suffix=suffix,
+                    memory=memory,
+                    cpus=cpus,
+                    lxcfs=lxcfs,
+                    server_ports=server_ports,
+                    healthchecks=healthchecks,
+                    mounts=mounts,
+                    volume_nodes=volume_nodes,
+                    **template_arguments
+                ).dump(path)
+
+        if not hosts:
+            write_compose(
+                output,
+                generate_nodes(),
+                itertools.chain([server_name], (node["name"] for node in generate_nodes()))
+            )
+            return {
+                "server_image": server_image,
+                "agent_image": agent_image,
+                "cluster": {
+                    "suffix": suffix,
+                    "domain": network_name,
+                    "server_name": server_name,
+                    "server_image": server_image,
+                    "agent_image": agent_image,
+                    # node names are generated by consumer, context size does not depend on node count
+                    "node_count": int(node_count),
+                    "node_template": node_template,
+                    "memory": memory,
+                    "cpus": cpus,
+                    "lxcfs": lxcfs,
+                    "server_ports": server_ports,
+                    "tmpfs": list(tmpfs),
+                    "volumes": list(data_volumes),
+                    "shared_stack_cache": shared_stack_cache
+                }
+            }
+
+        try:
+            docker_hosts = [DockerHost.parse(spec) for spec in hosts]
+        except ValueError as e:
+            click.get_current_context().fail(str(e))
+        placement = place_nodes(
+            docker_hosts,
+            itertools.chain([server_name], (node["name"] for node in generate_nodes())),
+            parse_size(memory),
+            float(cpus)
         )
 
-        LOG.info(f"Writing compose file to '{output}'")
-        open(output, "w").write(result)
+        output_root, output_ext = os.path.splitext(output)
+        LOG.info("Projected host utilization:")
+        for docker_host in docker_hosts:
+            memory_utilization, cpu_utilization = docker_host.utilization()
+            LOG.info(f"  {docker_host.name:<30} {len(docker_host.nodes):>5} nodes"
+                     f"  memory {memory_utilization:>6.1%}  cpus {cpu_utilization:>6.1%}")
+            if not docker_host.nodes:
+                continue
+            # compose can not wait for services from other files, agents on other hosts rely on entrypoint retries
+            host_nodes = (
+                dict(node, depends_on=[name for name in node["depends_on"] if placement[name] is docker_host])
+                for node in generate_nodes() if placement[node["name"]] is docker_host
+            )
+            write_compose(
+                f"{output_root}.{docker_host.name}{output_ext}",
+                host_nodes,
+                docker_host.nodes,
+                include_server=placement[server_name] is docker_host,
+                external_network=True
+            )
+
+        if network_driver == "overlay":
+            LOG.info(f"Create shared network once from swarm manager before starting compose files: "
+                     f"'docker network create --driver overlay --attachable {network_name}'")
+        else:
+            LOG.info(f"Create shared network on every host before starting compose files, with non-overlapping "
+                     f"'--ip-range' per host: 'docker network create --driver macvlan --subnet <subnet> "
+                     f"--ip-range <range> -o parent=<interface> {network_name}'")
 
     return PipelineCommand(2, "compose", callback, **kwargs)
 
 
+@cli.command(short_help=UP_SHORT_HELP)
+@click.option('-w', '--workers', **UP_WORKERS)
+@click.option('--timeout', **UP_TIMEOUT)
+@click.option('--node-timeout', **UP_NODE_TIMEOUT)
+@click.option('--replace', **UP_REPLACE)
+@click.option('--ambari-user', **UP_AMBARI_USER)
+@click.option('--ambari-password', **UP_AMBARI_PASSWORD)
+def up(**kwargs):
+    """
+    Command to start cluster generated by "compose" or "snapshot" command in pipeline.
+
+    Containers are started with local docker daemon, command finishes when all agents are registered in ambari
+    server and reports registration time of every node.
+    """
+
+    def callback(
+            context: object,
+            workers: int,
+            timeout: int,
+            node_timeout: int,
+            replace: bool,
+            ambari_user: str,
+            ambari_password: str
+    ):
+        if not isinstance(context, dict) or "cluster" not in context:
+            click.get_current_context().fail("'up' requires single host 'compose' or 'snapshot' command in pipeline")
+
+        from ambari_docker.cluster import ClusterLauncher, remove_cluster
+
+        cluster = context["cluster"]
+        if replace:
+            remove_cluster(cluster["suffix"])
+
+        launcher = ClusterLauncher(
+            cluster,
+            start_workers=workers,
+            timeout=timeout,
+            node_timeout=node_timeout,
+            ambari_user=ambari_user,
+            ambari_password=ambari_password
+        )
+        started = time.time()
+        latencies = launcher.up()
+
+        LOG.info("Agent registration times:")
+        for agent in launcher.agents:
+            LOG.info(f"  {agent.name:<40} {latencies[agent.name]:>8.1f}s")
+        LOG.info(f"Cluster '{cluster['suffix']}' is up in {time.time() - started:.1f} seconds")
+        return context
+
+    return PipelineCommand(4, "up", callback, **kwargs)
+
+
+@cli.command(short_help=SNAPSHOT_SHORT_HELP)
+@click.option('-s', '--suffix', **SNAPSHOT_SUFFIX)
+@click.option('--image-prefix', **SNAPSHOT_IMAGE_PREFIX)
+@click.option('-t', '--tag', **SNAPSHOT_TAG)
+@click.option('-o', '--output', **SNAPSHOT_OUTPUT)
+@click.option('-w', '--workers', **SNAPSHOT_WORKERS)
+@click.option('--restart/--no-restart', **SNAPSHOT_RESTART)
+@click.option('--stop-timeout', **SNAPSHOT_STOP_TIMEOUT)
+def snapshot(**kwargs):
+    """
+    Command to snapshot provisioned cluster.
+
+    Ambari services of every container of cluster with "--suffix" are stopped, containers are committed to images and
+    compose file that starts the same cluster, with the same hostnames and ambari state, from these images is written.
+    With "up" in pipeline, e.g. "snapshot --no-restart up --replace", cluster is recreated from snapshot right away.
+    """
+
+    def callback(
+            context: object,
+            suffix: str,
+            image_prefix: str,
+            tag: str,
+            output: str,
+            workers: int,
+            restart: bool,
+            stop_timeout: int
+    ):
+        from ambari_docker.cluster import snapshot_cluster
+
+        if tag is None:
+            tag = time.strftime("%Y%m%d%H%M%S")
+
+        nodes = snapshot_cluster(suffix, image_prefix, tag, workers=workers, restart=restart, stop_timeout=stop_timeout)
+        server = next(node for node in nodes if node.role == "server")
+        agents = sorted((node for node in nodes if node.role == "agent"), key=lambda node: node.name)
+        # cluster network is named after domain, see compose template
+        domain = next((network for network in server.networks if network not in ("bridge", "host", "none")), None)
+        if domain is None:
+            raise Exception(f"Ambari server container '{server.container.name}' is not connected to cluster network")
+        memory = str(server.memory) if server.memory else COMPOSE_MEMORY["default"]
+        cpus = str(server.cpus) if server.cpus else COMPOSE_CPUS["default"]
+
+        LOG.info(f"Writing compose file to '{output}'")
+        TEMPLATE_TOOL.stream(
+            COMPOSE_TEMPLATE,
+            server_hostname=server.name,
+            domain=domain,
+            nodes=[{"name": agent.name, "image": agent.image, "depends_on": [server.name]} for agent in agents],
+            server_image=server.image,
+            agent_image=server.image,
+            suffix=suffix,
+            memory=memory,
+            cpus=cpus,
+            lxcfs=server.lxcfs,
+            server_ports=server.ports,
+            healthchecks=True,
+            server_installed=True
+        ).dump(output)
+
+        return {
+            "cluster": {
+                "suffix": suffix,
+                "domain": domain,
+                "server_name": server.name,
+                "server_image": server.image,
+                "agent_image": server.image,
+                "node_images": {agent.name: agent.image for agent in agents},
+                "nodes": [agent.name for agent in agents],
+                "memory": memory,
+                "cpus": cpus,
+                "lxcfs": server.lxcfs,
+                "server_ports": server.ports
+            }
+        }
+
+    return PipelineCommand(3, "snapshot", callback, **kwargs)
+
+
 if __name__ == "__main__":
     cli()
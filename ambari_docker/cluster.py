@@ -0,0 +1,389 @@
+import concurrent.futures
+import logging
+import re
+import time
+from typing import Dict, Iterable, List
+
+import docker.errors
+import requests
+
+from ambari_docker.image_builder import get_docker_client
+from ambari_docker.metrics import METRICS
+from ambari_docker.placement import DataMounts
+from ambari_docker.utils import http_session, HTTP_TIMEOUT
+
+LOG = logging.getLogger("ClusterLauncher")
+
+# labels of cluster containers, used to find containers of the cluster by suffix
+CLUSTER_LABEL = "ambari-docker.cluster"
+NODE_LABEL = "ambari-docker.node"
+ROLE_LABEL = "ambari-docker.role"
+
+AMBARI_PORT = 8080
+
+_lxcfs_files = ("meminfo", "uptime", "swaps", "cpuinfo", "stat", "diskstats")
+
+
+def _parse_port(spec: str):
+    """
+    Converts compose port specification like '8080', '8080:8080' or '127.0.0.1:8080:8080' to docker sdk format.
+    """
+    parts = spec.split(":")
+    container_port = parts[-1] if "/" in parts[-1] else f"{parts[-1]}/tcp"
+    if len(parts) == 1:
+        return container_port, None
+    if len(parts) == 2:
+        return container_port, int(parts[0])
+    return container_port, (parts[0], int(parts[1]))
+
+
+def cluster_node_names(cluster: Dict) -> Iterable[str]:
+    """
+    Lazily yields agent names of *cluster*, "compose" passes node count and name template, "snapshot" passes names.
+    """
+    if "nodes" in cluster:
+        yield from cluster["nodes"]
+    else:
+        for number in range(cluster["node_count"]):
+            yield cluster["node_template"].format(number=number)
+
+
+class ClusterNode(object):
+    def __init__(self, name: str, role: str, image: str, suffix: str, domain: str):
+        self.name = name
+        self.role = role
+        self.image = image
+        self.container_name = f"{name}.{suffix}"
+        self.hostname = f"{name}.{suffix}.{domain}"
+        self.container = None
+        self.started = None
+        self.registered = None
+
+
+class ClusterLauncher(object):
+    """
+    Starts cluster containers with docker sdk and waits until all agents are registered in ambari server.
+
+    :param cluster: cluster parameters returned by "compose" command
+    :param start_workers: count of containers started concurrently
+    :param timeout: seconds to wait for the whole cluster
+    :param node_timeout: seconds to wait for agent registration after server api became available
+    """
+
+    def __init__(
+            self,
+            cluster: Dict,
+            start_workers: int = 8,
+            timeout: float = 1800,
+            node_timeout: float = 600,
+            ambari_user: str = "admin",
+            ambari_password: str = "admin"
+    ):
+        self.cluster = cluster
+        self.start_workers = start_workers
+        self.timeout = timeout
+        self.node_timeout = node_timeout
+        self.auth = (ambari_user, ambari_password)
+        self.mounts = DataMounts(
+            cluster["suffix"],
+            tmpfs=cluster.get("tmpfs", ()),
+            volumes=cluster.get("volumes", ()),
+            shared_stack_cache=cluster.get("shared_stack_cache", False)
+        )
+        self.server = ClusterNode(
+            cluster["server_name"], "server", cluster["server_image"], cluster["suffix"], cluster["domain"]
+        )
+        # snapshot clusters have own image for every node
+        node_images = cluster.get("node_images") or {}
+        self.agents = [
+            ClusterNode(
+                name, "agent", node_images.get(name, cluster["agent_image"]), cluster["suffix"], cluster["domain"]
+            )
+            for name in cluster_node_names(cluster)
+        ]
+
+    def _ensure_network(self):
+        docker_client = get_docker_client()
+        domain = self.cluster["domain"]
+        if not docker_client.networks.list(names=[domain]):
+            LOG.info(f"Creating network '{domain}'")
+            docker_client.networks.create(domain, driver="bridge")
+
+    def _ensure_volume(self, name: str):
+        # labeled like containers, so volumes are removed together with cluster
+        docker_client = get_docker_client()
+        try:
+            docker_client.volumes.get(name)
+        except docker.errors.NotFound:
+            docker_client.volumes.create(name, labels={CLUSTER_LABEL: self.cluster["suffix"]})
+
+    def _start(self, node: ClusterNode, ports: List[str] = ()):
+        volumes = {}
+        if self.cluster.get("lxcfs"):
+            for name in _lxcfs_files:
+                volumes[f"/var/lib/lxcfs/proc/{name}"] = {"bind": f"/proc/{name}", "mode": "rw"}
+        for volume, path, mode in self.mounts.node_volumes(node.name, node.role):
+            self._ensure_volume(volume)
+            volumes[volume] = {"bind": path, "mode": mode}
+        node.started = time.time()
+        node.container = get_docker_client().containers.run(
+            node.image,
+            name=node.container_name,
+            hostname=node.hostname,
+            network=self.cluster["domain"],
+            environment={"AMBARI_SERVER_HOSTNAME": self.server.hostname},
+            cap_add=["SYS_ADMIN", "SYS_RESOURCE"],
+            mem_limit=self.cluster["memory"],
+            nano_cpus=int(float(self.cluster["cpus"]) * 10 ** 9),
+            volumes=volumes,
+            tmpfs=self.mounts.node_tmpfs(),
+            ports=dict(_parse_port(port) for port in ports),
+            labels={CLUSTER_LABEL: self.cluster["suffix"], NODE_LABEL: node.name, ROLE_LABEL: node.role},
+            detach=True
+        )
+        LOG.debug(f"Started container '{node.container_name}'")
+
+    def _check_containers(self):
+        """
+        Fails if some cluster container is not running anymore.
+        """
+        containers = get_docker_client().containers.list(
+            all=True, filters={"label": f"{CLUSTER_LABEL}={self.cluster['suffix']}"}
+        )
+        for container in containers:
+            if container.status not in ("created", "running"):
+                logs = container.logs(tail=20).decode(errors="replace")
+                raise Exception(f"Container '{container.name}' is {container.status}, last output:\n{logs}")
+
+    def _server_url(self):
+        self.server.container.reload()
+        address = self.server.container.attrs["NetworkSettings"]["Networks"][self.cluster["domain"]]["IPAddress"]
+        return f"http://{address}:{AMBARI_PORT}/api/v1/hosts"
+
+    def _heartbeats(self, url):
+        """
+        Returns mapping of host name to its last heartbeat time in seconds, ambari keeps hosts in database, so hosts
+        of restored snapshot are listed before their agents connect.
+        """
+        try:
+            response = http_session().get(
+                url,
+                params={"fields": "Hosts/last_heartbeat_time"},
+                auth=self.auth,
+                timeout=HTTP_TIMEOUT
+            )
+        except requests.RequestException as e:
+            LOG.debug(f"Ambari api is not available: {e}")
+            return None
+        if response.status_code != 200:
+            LOG.debug(f"Ambari api answered with {response.status_code}")
+            return None
+        return {
+            item["Hosts"]["host_name"]: (item["Hosts"].get("last_heartbeat_time") or 0) / 1000
+            for item in response.json().get("items", [])
+        }
+
+    def up(self) -> Dict[str, float]:
+        """
+        Starts cluster and waits for registration of all agents.
+
+        :return: mapping of node name to seconds from container start till registration
+        """
+        started = time.time()
+        self._ensure_network()
+        with METRICS.span("cluster_start"):
+            self._start(self.server, self.cluster.get("server_ports", ()))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.start_workers) as executor:
+                for future in [executor.submit(self._start, agent) for agent in self.agents]:
+                    future.result()
+        LOG.info(f"Started {len(self.agents) + 1} containers in {time.time() - started:.1f} seconds")
+
+        with METRICS.span("cluster_registration"):
+            self._wait_for_registration(started)
+
+        latencies = {agent.name: agent.registered - agent.started for agent in self.agents}
+        for name, latency in latencies.items():
+            METRICS.record("node_registration", latency, node=name)
+        return latencies
+
+    def _wait_for_registration(self, started):
+        deadline = started + self.timeout
+        url = self._server_url()
+        server_ready = None
+        delay = 0.5
+        pending = {agent.hostname: agent for agent in self.agents}
+        # server api is awaited even for cluster without agents
+        while pending or server_ready is None:
+            self._check_containers()
+            heartbeats = self._heartbeats(url)
+            now = time.time()
+            progress = False
+            if heartbeats is not None:
+                if server_ready is None:
+                    server_ready = now
+                    self.server.registered = now
+                    LOG.info(f"Ambari server api is available after {now - self.server.started:.1f} seconds")
+                registered = [
+                    hostname for hostname, heartbeat in heartbeats.items()
+                    if hostname in pending and heartbeat >= pending[hostname].started
+                ]
+                for hostname in registered:
+                    agent = pending.pop(hostname)
+                    agent.registered = now
+                    progress = True
+                    LOG.info(f"Agent '{agent.name}' registered after {now - agent.started:.1f} seconds,"
+                             f" {len(pending)} left")
+                if pending and now - server_ready > self.node_timeout:
+                    stuck = ", ".join(sorted(agent.name for agent in pending.values()))
+                    raise Exception(f"Agents did not register in {self.node_timeout} seconds: {stuck}")
+            if now > deadline:
+                raise Exception(f"Cluster did not start in {self.timeout} seconds, {len(pending)} agents pending")
+            if pending or server_ready is None:
+                # poll often while agents keep registering, back off while nothing changes
+                delay = 0.5 if progress else min(delay * 2, 10)
+                time.sleep(min(delay, max(deadline - now, 0)))
+
+
+def remove_cluster(suffix: str):
+    """
+    Removes all containers and data volumes of cluster with *suffix*.
+    """
+    docker_client = get_docker_client()
+    for container in docker_client.containers.list(all=True, filters={"label": f"{CLUSTER_LABEL}={suffix}"}):
+        try:
+            container.remove(force=True)
+        except docker.errors.NotFound:
+            pass
+    for volume in docker_client.volumes.list(filters={"label": f"{CLUSTER_LABEL}={suffix}"}):
+        try:
+            volume.remove(force=True)
+        except docker.errors.NotFound:
+            pass
+
+
+# labels of snapshot images, identify cluster and node image was committed from
+SNAPSHOT_CLUSTER_LABEL = "ambari-docker.snapshot.cluster"
+SNAPSHOT_NODE_LABEL = "ambari-docker.snapshot.node"
+SNAPSHOT_HOSTNAME_LABEL = "ambari-docker.snapshot.hostname"
+SNAPSHOT_SOURCE_LABEL = "ambari-docker.snapshot.source-image"
+
+# commands that stop ambari and its database gracefully before container is committed
+_quiesce_commands = {
+    "server": ("supervisorctl stop all", "systemctl stop postgresql"),
+    "agent": ("supervisorctl stop all",)
+}
+
+
+def find_cluster_containers(suffix: str):
+    """
+    Returns containers of cluster with *suffix*, containers created before cluster labels were added are found by
+    '<node>.<suffix>' name.
+    """
+    docker_client = get_docker_client()
+    containers = docker_client.containers.list(all=True, filters={"label": f"{CLUSTER_LABEL}={suffix}"})
+    if not containers:
+        name_pattern = re.compile(rf"^[^/]+\.{re.escape(suffix)}$")
+        containers = [
+            container for container in docker_client.containers.list(all=True, filters={"name": f".{suffix}"})
+            if name_pattern.match(container.name)
+        ]
+    return containers
+
+
+class SnapshotNode(object):
+    def __init__(self, container):
+        self.container = container
+        attrs = container.attrs
+        self.hostname = attrs["Config"]["Hostname"]
+        if attrs["Config"].get("Domainname"):
+            self.hostname += f".{attrs['Config']['Domainname']}"
+        self.name = container.labels.get(NODE_LABEL) or container.name.rsplit(".", 1)[0]
+        environment = dict(item.split("=", 1) for item in attrs["Config"].get("Env") or [])
+        self.server_hostname = environment.get("AMBARI_SERVER_HOSTNAME")
+        self.role = container.labels.get(ROLE_LABEL) or ("server" if self.hostname == self.server_hostname else "agent")
+        self.source_image = attrs["Config"]["Image"]
+        self.memory = attrs["HostConfig"].get("Memory") or 0
+        self.cpus = (attrs["HostConfig"].get("NanoCpus") or 0) / 10 ** 9
+        self.networks = list(attrs["NetworkSettings"]["Networks"])
+        self.lxcfs = any(bind.startswith("/var/lib/lxcfs/") for bind in attrs["HostConfig"].get("Binds") or [])
+        self.ports = [
+            f"{binding['HostPort']}:{container_port.split('/')[0]}"
+            for container_port, bindings in (attrs["HostConfig"].get("PortBindings") or {}).items()
+            for binding in bindings or []
+        ]
+        # commit does not include data on tmpfs and volumes
+        self.data_mounts = [
+            mount["Destination"] for mount in attrs.get("Mounts") or []
+            if mount["Type"] in ("volume", "tmpfs")
+        ] + list(attrs["HostConfig"].get("Tmpfs") or {})
+        self.image = None
+
+
+def _quiesce(node: SnapshotNode, stop_timeout: int):
+    if node.container.status == "running":
+        for command in _quiesce_commands[node.role]:
+            exit_code, output = node.container.exec_run(command)
+            if exit_code != 0:
+                LOG.warning(f"'{command}' in '{node.container.name}' failed with {exit_code}: "
+                            f"{output.decode(errors='replace').strip()}")
+        node.container.stop(timeout=stop_timeout)
+    LOG.info(f"Stopped '{node.container.name}'")
+
+
+def _commit(node: SnapshotNode, suffix: str, repository: str, tag: str):
+    labels = {
+        SNAPSHOT_CLUSTER_LABEL: suffix,
+        SNAPSHOT_NODE_LABEL: node.name,
+        SNAPSHOT_HOSTNAME_LABEL: node.hostname,
+        SNAPSHOT_SOURCE_LABEL: node.source_image
+    }
+    changes = [f'LABEL {k}="{v}"' for k, v in labels.items()]
+    if node.role == "server":
+        changes.append('ENV AMBARI_SERVER_INSTALLED="true"')
+    node.container.commit(repository=repository, tag=tag, changes=changes)
+    node.image = f"{repository}:{tag}"
+    LOG.info(f"Committed '{node.container.name}' to '{node.image}'")
+
+
+def snapshot_cluster(
+        suffix: str,
+        image_prefix: str,
+        tag: str,
+        workers: int = 8,
+        restart: bool = True,
+        stop_timeout: int = 60
+) -> List[SnapshotNode]:
+    """
+    Commits all containers of cluster with *suffix* to '<image_prefix>/<suffix>-<node>:<tag>' images.
+
+    Ambari services and database are stopped and containers are stopped before commit, so images contain consistent
+    state. Containers are started again afterwards if *restart* is set.
+    """
+    nodes = [SnapshotNode(container) for container in find_cluster_containers(suffix)]
+    if not nodes:
+        raise Exception(f"No containers found for cluster '{suffix}'")
+    if not any(node.role == "server" for node in nodes):
+        raise Exception(f"Ambari server container of cluster '{suffix}' not found")
+
+    for node in nodes:
+        if node.data_mounts:
+            LOG.warning(f"Data in {', '.join(node.data_mounts)} of '{node.container.name}' is not included in snapshot")
+
+    was_running = [node for node in nodes if node.container.status == "running"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        with METRICS.span("snapshot_quiesce"):
+            for future in [executor.submit(_quiesce, node, stop_timeout) for node in nodes]:
+                future.result()
+        try:
+            with METRICS.span("snapshot_commit"):
+                futures = [
+                    executor.submit(_commit, node, suffix, f"{image_prefix}/{suffix}-{node.name}", tag)
+                    for node in nodes
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            if restart:
+                for future in [executor.submit(node.container.start) for node in was_running]:
+                    future.result()
+    return nodes
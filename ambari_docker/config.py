@@ -1,6 +1,23 @@
+import os
+
 import jinja2
 import posixpath as path
 from ambari_docker.data import DATA_ROOT
+from ambari_docker.metrics import METRICS
+
+# root folder for all persistent caches
+CACHE_ROOT = os.environ.get("AMBARI_DOCKER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "ambari-docker"))
+
+# default base image for every supported os
+OS_BASE_IMAGES = {
+    'centos7': 'centos:7',
+    'amazonlinux2': 'amazonlinux:2'
+}
+
+SUPPORTED_OS = tuple(OS_BASE_IMAGES)
+
+# templates compiled to python modules at install time, see setup.py
+COMPILED_TEMPLATES_ROOT = os.path.join(DATA_ROOT, "_compiled_templates")
 
 
 class _RelativeEnvironment(jinja2.Environment):
@@ -8,14 +25,71 @@ class _RelativeEnvironment(jinja2.Environment):
         return path.normpath(path.join(path.dirname(parent), template))
 
 
+class _LazyBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    Creates cache directory on first write, so importing module does not touch user home directory.
+    """
+
+    def dump_bytecode(self, bucket):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+
+def _is_template(template_path):
+    name = path.basename(template_path)
+    return template_path.startswith("templates/") and (name.startswith("Dockerfile") or name.endswith(".yml"))
+
+
 class TemplateTool(object):
-    def __init__(self):
+    """
+    Renders packaged templates.
+
+    Templates precompiled at install time are used when present. Other templates are compiled on first use and
+    their bytecode is stored in *bytecode_cache_dir*, so next processes skip parsing, None disables bytecode cache.
+    """
+
+    def __init__(self, bytecode_cache_dir: str = os.path.join(CACHE_ROOT, "templates")):
+        loader = jinja2.FileSystemLoader(DATA_ROOT)
+        if os.path.isdir(COMPILED_TEMPLATES_ROOT):
+            loader = jinja2.ChoiceLoader([jinja2.ModuleLoader(COMPILED_TEMPLATES_ROOT), loader])
         self.env = _RelativeEnvironment(
-            loader=jinja2.FileSystemLoader(DATA_ROOT)
+            loader=loader,
+            bytecode_cache=self._bytecode_cache(bytecode_cache_dir)
         )
 
+    @staticmethod
+    def _bytecode_cache(bytecode_cache_dir):
+        if bytecode_cache_dir is None:
+            return None
+        return _LazyBytecodeCache(bytecode_cache_dir)
+
+    def get_template(self, template_path) -> jinja2.Template:
+        with METRICS.span("template_load", template=template_path):
+            return self.env.get_template(template_path)
+
     def render(self, template_path, **template_arguments):
-        return self.env.get_template(template_path).render(**template_arguments)
+        template = self.get_template(template_path)
+        with METRICS.span("template_render", template=template_path):
+            return template.render(**template_arguments)
+
+    def stream(self, template_path, buffer_size=64, **template_arguments) -> jinja2.environment.TemplateStream:
+        """
+        Renders template lazily, *template_arguments* may contain generators, that are consumed while output is
+        written with *dump* of resulting stream. Output is written in batches of *buffer_size* template chunks.
+        """
+        template_stream = self.get_template(template_path).stream(**template_arguments)
+        template_stream.enable_buffering(buffer_size)
+        return template_stream
+
+    def precompile(self, target_dir: str):
+        """
+        Compiles all packaged templates to python modules in *target_dir*.
+        """
+        source_env = self.env.overlay(loader=jinja2.FileSystemLoader(DATA_ROOT), bytecode_cache=None)
+        source_env.compile_templates(target_dir, filter_func=_is_template, zip=None, ignore_errors=False)
 
     @staticmethod
     def get_template_root(template_path):
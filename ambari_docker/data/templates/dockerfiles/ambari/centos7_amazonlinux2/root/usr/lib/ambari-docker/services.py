@@ -0,0 +1,195 @@
+"""
+Services managed by fake systemctl, shared by systemctl client and ambari-docker-services daemon.
+
+Only standard library is used, so module can be loaded by systemctl that runs without site packages.
+"""
+import abc
+import errno
+import os
+import signal
+import subprocess
+import time
+
+SOCKET_PATH = "/var/run/ambari-docker-services.sock"
+# cached status answers written by daemon, read by systemctl without starting python
+STATUS_DIR = "/var/run/ambari-docker-services"
+
+STATUS_RUNNING = 0
+STATUS_STOPPED = 3
+UNSUPPORTED = -1
+
+STOP_TIMEOUT = 60
+
+PG_ENV = {
+    "PGDATA": "/var/lib/pgsql/data",
+    "PGPORT": "5432"
+}
+
+PG_START_CMD = 'su postgres -c "/usr/bin/postgresql-check-db-dir ${PGDATA} && /usr/bin/pg_ctl start -D ${PGDATA} -s -o \\"-p ${PGPORT}\\" -w -t 300 > /tmp/pgsql.log"'
+# note "> /tmp/pgsql.log", we need this because of sick "feature" of pg_ctl, it will pass your stdout to background process
+# causing subprocess.check_output hangs with zombie su process :)
+PG_STOP_CMD = 'su postgres -c "/usr/bin/pg_ctl stop -D ${PGDATA} -s -m fast"'
+PG_RELOAD_CMD = 'su postgres -c "/usr/bin/pg_ctl reload -D ${PGDATA} -s"'
+
+KRB_5_KDC_START_CMD = ". /etc/sysconfig/krb5kdc; /usr/sbin/krb5kdc -P /var/run/krb5kdc.pid $KRB5KDC_ARGS"
+KADMIN_START_CMD = ". /etc/sysconfig/kadmin; /usr/sbin/_kadmind -P /var/run/kadmind.pid $KADMIND_ARGS"
+
+
+def run(cmd, env=None):
+    proc = subprocess.Popen(
+        cmd,
+        shell=True,
+        env=env,
+        stderr=subprocess.STDOUT,
+        stdout=subprocess.PIPE
+    )
+    out, _ = proc.communicate()
+    return out.decode(), proc.returncode
+
+
+def _read_pid(pid_file):
+    try:
+        with open(pid_file) as f:
+            return int(f.readline().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Service(object):
+    """
+    Service with pid file, status is checked by signalling pid directly, without any subprocess.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, name, pid_file):
+        self.name = name
+        self.pid_file = pid_file
+        self._pid = None
+
+    def pid(self):
+        if self._pid is not None and _is_alive(self._pid):
+            return self._pid
+        pid = _read_pid(self.pid_file)
+        self._pid = pid if pid is not None and _is_alive(pid) else None
+        return self._pid
+
+    def status(self):
+        if self.pid() is None:
+            return STATUS_STOPPED, "stopped"
+        return STATUS_RUNNING, "running"
+
+    @abc.abstractmethod
+    def start(self):
+        pass
+
+    @abc.abstractmethod
+    def stop(self):
+        pass
+
+    @abc.abstractmethod
+    def reload(self):
+        pass
+
+
+class PostgresService(Service):
+    def __init__(self):
+        super(PostgresService, self).__init__("postgresql", os.path.join(PG_ENV["PGDATA"], "postmaster.pid"))
+
+    @staticmethod
+    def _result(output, code):
+        if code == 0:
+            return 0, ""
+        return STATUS_STOPPED, output
+
+    def start(self):
+        return self._result(*run(PG_START_CMD, PG_ENV))
+
+    def stop(self):
+        output, code = run(PG_STOP_CMD, PG_ENV)
+        if code != 0 and "PID file" in output and "does not exist" in output:
+            return 0, ""
+        return self._result(output, code)
+
+    def reload(self):
+        return self._result(*run(PG_RELOAD_CMD, PG_ENV))
+
+
+class PidFileService(Service):
+    """
+    Daemon started by shell command, stopped and reloaded by signals.
+    """
+
+    def __init__(self, name, pid_file, start_cmd):
+        super(PidFileService, self).__init__(name, pid_file)
+        self.start_cmd = start_cmd
+
+    def start(self):
+        output, code = run(self.start_cmd)
+        if code == 0:
+            return 0, ""
+        return STATUS_STOPPED, output
+
+    def stop(self):
+        pid = self.pid()
+        if pid is None:
+            return STATUS_STOPPED, "{0} is not running".format(self.name)
+        os.kill(pid, signal.SIGTERM)
+        deadline = time.time() + STOP_TIMEOUT
+        while _is_alive(pid) and time.time() < deadline:
+            time.sleep(0.1)
+        if _is_alive(pid):
+            return STATUS_STOPPED, "{0} did not stop in {1} seconds".format(self.name, STOP_TIMEOUT)
+        return 0, ""
+
+    def reload(self):
+        pid = self.pid()
+        if pid is None:
+            return STATUS_STOPPED, "{0} is not running".format(self.name)
+        os.kill(pid, signal.SIGHUP)
+        return 0, ""
+
+
+SERVICES = dict((service.name, service) for service in (
+    PostgresService(),
+    PidFileService("krb5kdc", "/var/run/krb5kdc.pid", KRB_5_KDC_START_CMD),
+    PidFileService("kadmin", "/var/run/kadmind.pid", KADMIN_START_CMD)
+))
+
+COMMANDS = ("start", "stop", "status", "reload")
+
+
+def status_file(name):
+    return os.path.join(STATUS_DIR, "{0}.status".format(name))
+
+
+def normalize_args(args):
+    args = list(args)
+    if len(args) >= 2:
+        parts = args[-1].split(".")
+        if parts[-1] == "service":
+            args[-1] = ".".join(parts[:len(parts) - 1])
+    return args
+
+
+def handle(args):
+    """
+    Executes systemctl command *args*.
+
+    :return: tuple of exit code and output
+    """
+    args = normalize_args(args)
+    if args == ["show", "-p", "Environment", "postgresql"]:
+        return 0, "\n".join("Environment={0}={1}".format(k, PG_ENV[k]) for k in ("PGPORT", "PGDATA"))
+    if len(args) == 2 and args[0] in COMMANDS and args[1] in SERVICES:
+        command, service = args
+        return getattr(SERVICES[service], command)()
+    # TODO add mock for "service chronyd status" command
+    return UNSUPPORTED, "systemctl wrapper does not support arguments '{args}'".format(args=" ".join(args))
@@ -0,0 +1,54 @@
+"""
+Client of systemctl replacement, commands are executed by ambari-docker-services daemon.
+
+Started by /usr/bin/systemctl without site packages to start fast, when status can not be answered from file cache.
+When daemon is not running, e.g. in RUN steps of docker build, command is executed in this process.
+"""
+from __future__ import print_function
+
+import json
+import socket
+import sys
+
+sys.path.insert(0, "/usr/lib/ambari-docker")
+
+import services
+
+# starting postgresql waits up to 300 seconds
+REQUEST_TIMEOUT = 330
+
+
+def _request(client, args):
+    try:
+        client.sendall((json.dumps(args) + "\n").encode())
+        response = b""
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+    finally:
+        client.close()
+    result = json.loads(response)
+    return result["code"], result["output"]
+
+
+def _run(args):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(REQUEST_TIMEOUT)
+    try:
+        client.connect(services.SOCKET_PATH)
+    except socket.error:
+        client.close()
+        return services.handle(args)
+    try:
+        return _request(client, args)
+    except (socket.error, ValueError) as e:
+        return services.UNSUPPORTED, "service manager did not answer: {0}".format(e)
+
+
+if __name__ == "__main__":
+    code, output = _run(sys.argv[1:])
+    if output:
+        print(output)
+    sys.exit(code)
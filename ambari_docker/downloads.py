@@ -0,0 +1,322 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+import requests
+
+from ambari_docker.config import CACHE_ROOT
+from ambari_docker.metrics import METRICS
+from ambari_docker.utils import hash_file, http_session, HTTP_TIMEOUT
+
+LOG = logging.getLogger("DownloadCache")
+
+_supported_checksums = ("sha256", "sha1", "md5")
+
+
+def _expected_checksum(url: str):
+    """
+    Extracts checksum from url fragment, e.g. 'http://host/mpack.tar.gz#sha256=<hex digest>'.
+    """
+    fragment = urllib.parse.urlparse(url).fragment
+    if "=" in fragment:
+        algorithm, digest = fragment.split("=", 1)
+        if algorithm in _supported_checksums:
+            return algorithm, digest.lower()
+    return None
+
+
+class DownloadCache(object):
+    """
+    Persistent cache for remote artifacts.
+
+    Every url is stored in *directory* as data file plus json file with metadata. Cached files are revalidated with
+    ETag/Last-Modified on each fetch, interrupted downloads are resumed with HTTP Range requests. Least recently used
+    files are removed when cache size exceeds *max_size*, files fetched by current process are never removed.
+
+    At most *max_workers* downloads run at once in process, whatever number of threads fetch. Every url is locked with
+    lock file, so processes sharing *directory* do not download the same url at the same time.
+    """
+
+    def __init__(
+            self,
+            directory: str = os.path.join(CACHE_ROOT, "downloads"),
+            max_size: int = 10 * 1024 ** 3,
+            max_workers: int = 4,
+            retries: int = 5,
+            timeout=HTTP_TIMEOUT,
+            chunk_size: int = 1024 * 1024
+    ):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_workers = max_workers
+        self.retries = retries
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._downloads = threading.BoundedSemaphore(max_workers)
+        self._used_keys = set()
+        # total size of cached files, known after first eviction scan and updated by downloads
+        self._size = None
+        self._size_lock = threading.Lock()
+
+    def configure(self, directory: str = None, max_size: int = None, max_workers: int = None):
+        if directory is not None:
+            self.directory = directory
+            self._size = None
+        if max_size is not None:
+            self.max_size = max_size
+        if max_workers is not None:
+            self.max_workers = max_workers
+            self._downloads = threading.BoundedSemaphore(max_workers)
+
+    def _lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _paths(self, key):
+        data_path = os.path.join(self.directory, key)
+        return data_path, f"{data_path}.json", f"{data_path}.part"
+
+    @staticmethod
+    def _file_lock(data_path):
+        """
+        Opens lock file of *data_path* and locks it exclusively, lock is released when returned file is closed.
+        """
+        lock_file = open(f"{data_path}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except OSError:
+            lock_file.close()
+            raise
+        return lock_file
+
+    @staticmethod
+    def _read_meta(meta_path):
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_meta(meta_path, meta):
+        tmp_path = f"{meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    @staticmethod
+    def _key(download_url):
+        return hashlib.sha256(download_url.encode()).hexdigest()
+
+    def is_cached(self, url: str) -> bool:
+        data_path, meta_path, _ = self._paths(self._key(urllib.parse.urldefrag(url)[0]))
+        return os.path.isfile(data_path) and os.path.isfile(meta_path)
+
+    def fetch(self, url: str, revalidate: bool = True) -> str:
+        """
+        Returns path to local copy of *url*, downloading or revalidating it if needed.
+
+        :param revalidate: check cached copy with server, can be disabled for immutable urls
+        """
+        download_url = urllib.parse.urldefrag(url)[0]
+        key = self._key(download_url)
+        os.makedirs(self.directory, exist_ok=True)
+
+        data_path, meta_path, part_path = self._paths(key)
+        with self._lock(key), self._file_lock(data_path):
+            self._used_keys.add(key)
+            expected_checksum = _expected_checksum(url)
+            meta = self._read_meta(meta_path)
+            if meta is not None and os.path.isfile(data_path):
+                with METRICS.span("revalidate", url=download_url):
+                    is_valid = self._matches_checksum(meta, data_path, expected_checksum) and \
+                               (not revalidate or self._is_fresh(download_url, meta, data_path))
+                if is_valid:
+                    os.utime(data_path)
+                    METRICS.add("download_cache_hits", 1)
+                    LOG.info(f"Using cached '{download_url}'")
+                    return data_path
+
+            METRICS.add("download_cache_misses", 1)
+            with self._downloads, METRICS.span("download", url=download_url):
+                self._download(download_url, data_path, meta_path, part_path, expected_checksum)
+
+        self._add_size(os.path.getsize(data_path))
+        return data_path
+
+    def _add_size(self, size):
+        """
+        Counts downloaded file in cache size, cache directory is scanned only when size is unknown or over limit.
+        """
+        with self._size_lock:
+            if self._size is not None:
+                self._size += size
+                if self._size <= self.max_size:
+                    return
+            self._evict()
+
+    @staticmethod
+    def _matches_checksum(meta, data_path, expected_checksum):
+        if not expected_checksum:
+            return True
+        algorithm, expected_digest = expected_checksum
+        if algorithm == "sha256":
+            return meta.get("sha256") == expected_digest
+        hasher = hashlib.new(algorithm)
+        hash_file(hasher, data_path)
+        return hasher.hexdigest() == expected_digest
+
+    def _is_fresh(self, url, meta, data_path):
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        if not headers:
+            return False
+        try:
+            with http_session().get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                if response.status_code == 304:
+                    return True
+                if response.status_code == 200:
+                    return (
+                            meta.get("etag") == response.headers.get("ETag") and
+                            meta.get("last_modified") == response.headers.get("Last-Modified") and
+                            meta.get("size") == os.path.getsize(data_path)
+                    )
+                response.raise_for_status()
+        except requests.RequestException as e:
+            LOG.warning(f"Failed to revalidate '{url}', using cached copy: {e}")
+            return True
+        return False
+
+    def _download(self, url, data_path, meta_path, part_path, expected_checksum):
+        part_meta_path = f"{part_path}.json"
+        part_meta = self._read_meta(part_meta_path) or {}
+        if part_meta.get("url") != url and os.path.exists(part_path):
+            os.remove(part_path)
+
+        for attempt in range(1, self.retries + 1):
+            try:
+                self._download_attempt(url, part_path, part_meta_path, part_meta)
+                break
+            except (requests.RequestException, IOError) as e:
+                if attempt == self.retries:
+                    raise Exception(f"Failed to download '{url}' after {attempt} attempts: {e}")
+                delay = 2 ** attempt
+                LOG.warning(f"Download of '{url}' failed ({e}), retrying in {delay} seconds")
+                time.sleep(delay)
+                part_meta = self._read_meta(part_meta_path) or {}
+
+        sha256 = hashlib.sha256()
+        hash_file(sha256, part_path)
+        if expected_checksum:
+            algorithm, expected_digest = expected_checksum
+            hasher = sha256 if algorithm == "sha256" else hashlib.new(algorithm)
+            if hasher is not sha256:
+                hash_file(hasher, part_path)
+            if hasher.hexdigest() != expected_digest:
+                os.remove(part_path)
+                os.remove(part_meta_path)
+                raise Exception(f"Checksum mismatch for '{url}': expected {algorithm} {expected_digest},"
+                                f" got {hasher.hexdigest()}")
+
+        os.replace(part_path, data_path)
+        os.remove(part_meta_path)
+        self._write_meta(meta_path, {
+            "url": url,
+            "etag": part_meta.get("etag"),
+            "last_modified": part_meta.get("last_modified"),
+            "size": os.path.getsize(data_path),
+            "sha256": sha256.hexdigest()
+        })
+        LOG.info(f"Downloaded '{url}' ({os.path.getsize(data_path)} bytes)")
+
+    def _download_attempt(self, url, part_path, part_meta_path, part_meta):
+        # encoded body would not match Content-Length and ranges of partial file
+        headers = {"Accept-Encoding": "identity"}
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            validator = part_meta.get("etag") or part_meta.get("last_modified")
+            if validator:
+                headers["If-Range"] = validator
+
+        with http_session().get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 416:
+                # partial file is complete or broken, start from scratch on next attempt
+                os.remove(part_path)
+                raise IOError(f"Server rejected range {offset}-")
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                LOG.info(f"Resuming download of '{url}' from byte {offset}")
+                mode = "ab"
+            else:
+                LOG.info(f"Downloading '{url}'...")
+                offset = 0
+                mode = "wb"
+                part_meta.clear()
+                part_meta.update({
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified")
+                })
+                self._write_meta(part_meta_path, part_meta)
+
+            # iter_content decodes body if server encodes it anyway, so Content-Length is not size of file
+            content_length = response.headers.get("Content-Length")
+            if content_length is not None and response.headers.get("Content-Encoding", "identity") == "identity":
+                expected_size = offset + int(content_length)
+            else:
+                expected_size = None
+
+            with open(part_path, mode, buffering=self.chunk_size) as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    METRICS.add("download_bytes", len(chunk))
+
+        if expected_size is not None and os.path.getsize(part_path) != expected_size:
+            raise IOError(f"Incomplete download, got {os.path.getsize(part_path)} of {expected_size} bytes")
+
+    def evict(self):
+        """
+        Removes least recently used files until cache size fits *max_size*.
+        """
+        with self._size_lock:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            data_path = os.path.join(self.directory, name)
+            if name.endswith((".json", ".part", ".tmp", ".lock")) or not os.path.isfile(data_path):
+                continue
+            stat = os.stat(data_path)
+            total_size += stat.st_size
+            if name not in self._used_keys:
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            data_path, meta_path, _ = self._paths(name)
+            LOG.info(f"Evicting '{data_path}' from download cache")
+            for path in (meta_path, data_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+        self._size = total_size
+
+
+DOWNLOAD_CACHE = DownloadCache()
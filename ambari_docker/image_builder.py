@@ -1,24 +1,32 @@
+import concurrent.futures
+import hashlib
+import io
 import logging
 import os
+import re
+import shlex
+import tarfile
+import threading
+import time
 import urllib.parse
-from collections import defaultdict
-from typing import Union, List
+from collections import defaultdict, OrderedDict
+from typing import Union, List, Callable, Dict, Iterable
 
 import docker
 import docker.errors
-import requests
+from docker.utils import parse_repository_tag
 
-from ambari_docker.config import TEMPLATE_TOOL
-from ambari_docker.utils import TempDirectory, copy_tree, ProcessRunner, download_file, copy_file
+from ambari_docker.config import TEMPLATE_TOOL, OS_BASE_IMAGES
+from ambari_docker.downloads import DOWNLOAD_CACHE
+from ambari_docker.metrics import METRICS
+from ambari_docker.repositories import REPO_FILE_RESOLVER
+from ambari_docker.utils import TarStream, ProcessRunner, hash_file, hash_tree
+from ambari_docker.yum_proxy import YUM_PROXY
 
 PURGE_PREFIX = "purge+"
 
-docker_client = docker.from_env()
-
-_os_to_image = {
-    'centos7': 'centos:7',
-    'amazonlinux2': 'amazonlinux:2'
-}
+_docker_client = None
+_docker_client_lock = threading.Lock()
 
 _os_to_template_path = {
     'centos7': 'centos7_amazonlinux2',
@@ -37,18 +45,57 @@ _check_equality_labels = ('ambari.repo', 'ambari.build', 'ambari.os')
 # this labels in base image must be missing or false in base image
 _check_false_labels = ('ambari.server', 'ambari.agent')
 
+# images with this label have pip, supervisor and ambari repository prepared, component images are built from them
+BASE_IMAGE_LABEL = "ambari.base"
+
+# registry digest of image ambari base image is built from
+BASE_IMAGE_DIGEST_LABEL = "ambari.base.from"
+
+# label with hash of build inputs, image is not rebuilt while hash stays the same
+CONTEXT_HASH_LABEL = "ambari-docker.context-hash"
+
+# prewarmed server images keep time from start of already initialized server till api readiness, measured in
+# prewarm stage of the build and passed to final stage as build argument
+STARTUP_TIME_LABEL = "ambari.server.startup-seconds"
+STARTUP_TIME_FILE = "/var/lib/ambari-server/startup-time-ms"
+STARTUP_TIME_BUILD_ARG = "STARTUP_SECONDS"
+PREWARM_STAGE = "prewarmed"
+
+_base_image_locks = {}
+_base_image_locks_lock = threading.Lock()
+
 LOG = logging.getLogger("DockerImageBuilder")
 DOCKERFILE_LOGGER = logging.getLogger("DockerfileLogger")
+BUILD_LOGGER = logging.getLogger("DockerBuildLogger")
+
+
+def get_docker_client() -> docker.DockerClient:
+    """
+    Returns process-wide docker client, connection is configured from environment on first use.
+    """
+    global _docker_client
+    with _docker_client_lock:
+        if _docker_client is None:
+            _docker_client = docker.from_env()
+        return _docker_client
+
+
+def get_bridge_gateway() -> str:
+    """
+    Returns address of docker host in default bridge network, reachable from build containers.
+    """
+    return get_docker_client().networks.get("bridge").attrs["IPAM"]["Config"][0]["Gateway"]
 
 
 def _get_base_image_info(base_image_name, repo_os, existing_labels=None):
     if not base_image_name:
-        base_image_name = _os_to_image[repo_os]
+        base_image_name = OS_BASE_IMAGES[repo_os]
     try:
-        base_image = docker_client.images.get(base_image_name)
+        base_image = get_docker_client().images.get(base_image_name)
     except docker.errors.ImageNotFound:
         LOG.info(f"Pulling base image '{base_image_name}'...")
-        base_image = docker_client.images.pull(base_image_name)
+        with METRICS.span("pull", image=base_image_name):
+            base_image = get_docker_client().images.pull(base_image_name)
         LOG.info(f"Pulled base image '{base_image_name}'")
 
     if not existing_labels:
@@ -78,7 +125,99 @@ def _get_base_image_info(base_image_name, repo_os, existing_labels=None):
 
     base_image_labels.update(existing_labels)
 
-    return base_image_name, base_image_labels
+    return base_image_name, base_image_labels, base_image.id
+
+
+def _image_digests(image) -> List[str]:
+    return [repo_digest.split("@", 1)[1] for repo_digest in image.attrs.get("RepoDigests") or []]
+
+
+def _pull_image(image_name: str, progress_interval: float = 5):
+    """
+    Pulls *image_name* and logs download progress of all layers every *progress_interval* seconds.
+    """
+    repository, tag = parse_repository_tag(image_name)
+    layers = {}
+    last_report = time.monotonic()
+    for chunk in get_docker_client().api.pull(repository, tag=tag or "latest", stream=True, decode=True):
+        if "error" in chunk:
+            raise Exception(f"Failed to pull '{image_name}': {chunk['error']}")
+        if "id" not in chunk:
+            continue
+        layer = layers.setdefault(chunk["id"], {"current": 0, "total": 0, "done": False})
+        progress = chunk.get("progressDetail") or {}
+        if chunk.get("status") == "Downloading" and progress.get("total"):
+            layer["current"], layer["total"] = progress["current"], progress["total"]
+        elif chunk.get("status") in ("Download complete", "Pull complete", "Already exists"):
+            layer["done"] = True
+            layer["current"] = layer["total"]
+        if time.monotonic() - last_report >= progress_interval:
+            last_report = time.monotonic()
+            done = sum(1 for layer in layers.values() if layer["done"])
+            current = sum(layer["current"] for layer in layers.values()) / 1024 ** 2
+            total = sum(layer["total"] for layer in layers.values()) / 1024 ** 2
+            LOG.info(f"[{image_name}] {done}/{len(layers)} layers, {current:.1f}/{total:.1f} MB")
+    return get_docker_client().images.get(image_name)
+
+
+def _prepull_image(image_name: str):
+    try:
+        local_image = get_docker_client().images.get(image_name)
+    except docker.errors.ImageNotFound:
+        local_image = None
+
+    try:
+        registry_digest = get_docker_client().images.get_registry_data(image_name).id
+    except docker.errors.APIError as e:
+        if local_image is None:
+            raise Exception(f"Base image '{image_name}' is not available locally and in registry: {e}")
+        # locally built or private images without registry access are used as is
+        LOG.warning(f"Can not resolve '{image_name}' in registry, using local image: {e.explanation}")
+        return None
+
+    if local_image is not None and registry_digest in _image_digests(local_image):
+        LOG.info(f"Base image '{image_name}' is up to date ({registry_digest})")
+        METRICS.add("base_image_pulls_skipped", 1)
+        return registry_digest
+
+    LOG.info(f"Pulling base image '{image_name}' ({registry_digest})...")
+    with METRICS.span("pull", image=image_name):
+        _pull_image(image_name)
+    LOG.info(f"Pulled base image '{image_name}'")
+    return registry_digest
+
+
+def prepull_base_images(image_names: Iterable[str], max_workers: int = 4) -> Dict[str, str]:
+    """
+    Makes sure local copies of *image_names* match registry, pulls outdated and missing images concurrently.
+    Images whose local digest equals registry digest are not pulled.
+
+    :return: mapping of image name to registry digest, None for images that are not available in registry
+    """
+    image_names = list(dict.fromkeys(image_names))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(image_names, executor.map(_prepull_image, image_names)))
+
+
+def parse_repository_url(ambari_repo_url: str):
+    """
+    Extracts os, stack name and build number from repository url like
+    'http://host/ambari/centos7/2.x/BUILDS/2.7.0.0-123'.
+
+    :return: tuple (os, stack, build)
+    """
+    path_parts = urllib.parse.urlparse(ambari_repo_url).path.split('/')
+    return path_parts[-4], path_parts[-5], path_parts[-1]
+
+
+def repository_for_os(ambari_repo_url: str, repo_os: str) -> str:
+    """
+    Returns url of the same repository build for another os.
+    """
+    url = urllib.parse.urlparse(ambari_repo_url)
+    path_parts = url.path.split('/')
+    path_parts[-4] = repo_os
+    return urllib.parse.urlunparse(url._replace(path="/".join(path_parts)))
 
 
 class ContextFile(object):
@@ -86,20 +225,31 @@ class ContextFile(object):
         self.source = source
         self.destination = destination
         self.destination_folder = os.path.dirname(self.destination).lstrip("/")
+        self.local_path = None
 
-    def copy_to_context(self, context_directory: str):
-        context_destination_directory = os.path.join(context_directory, self.destination_folder)
-        os.makedirs(context_destination_directory, exist_ok=True)
-        context_file_destination = os.path.join(context_directory, self.destination.lstrip("/"))
+    def prepare(self):
+        """
+        Makes source available locally, remote sources are fetched through download cache.
+        """
         if "http" in self.source:
-            LOG.info(f"Trying to download '{self.source}' to '{context_file_destination}'")
-            download_file(self.source, context_file_destination)
-            LOG.info(f"Downloaded '{self.source}' to '{context_file_destination}'")
+            self.local_path = DOWNLOAD_CACHE.fetch(self.source)
+        elif os.path.isfile(self.source):
+            self.local_path = self.source
         else:
-            if os.path.exists(self.source):
-                copy_file(self.source, context_file_destination)
-            else:
-                raise Exception(f"Source file '{self.source}' does not exists")
+            raise Exception(f"Source file '{self.source}' does not exists")
+
+    def add_to_tar(self, tar: tarfile.TarFile):
+        tar.add(self.local_path, arcname=self.destination.lstrip("/"), recursive=False)
+
+    def update_hash(self, hasher):
+        hasher.update(self.destination.encode())
+        if "http" in self.source:
+            # remote content is not fetched for hashing, url is expected to point to immutable artifact
+            hasher.update(self.source.encode())
+        elif os.path.exists(self.source):
+            hash_file(hasher, self.source)
+        else:
+            raise Exception(f"Source file '{self.source}' does not exists")
 
 
 class ContextDirectory(object):
@@ -107,53 +257,227 @@ class ContextDirectory(object):
         self.source = source
         self.destination = destination.lstrip("/")
 
-    def copy_to_context(self, context_directory: str):
-        context_destination_path = os.path.join(context_directory, self.destination)
-        LOG.info(f"Copying folder '{self.source}' to '{context_destination_path}'")
-        copy_tree(self.source, context_destination_path)
+    def prepare(self):
+        pass
+
+    def add_to_tar(self, tar: tarfile.TarFile):
+        LOG.info(f"Adding folder '{self.source}' to context as '/{self.destination}'")
+        for item in sorted(os.listdir(self.source)):
+            tar.add(os.path.join(self.source, item), arcname=os.path.join(self.destination, item))
+
+    def update_hash(self, hasher):
+        hasher.update(self.destination.encode())
+        hash_tree(hasher, self.source)
+
+
+def _get_context_hash(
+        docker_file_content: str,
+        context_data: List[Union[ContextFile, ContextDirectory]],
+        base_image_id: str = None
+):
+    hasher = hashlib.sha256()
+    hasher.update(docker_file_content.encode())
+    hasher.update(str(base_image_id).encode())
+    for data in context_data:
+        data.update_hash(hasher)
+    return hasher.hexdigest()
+
+
+def _find_cached_image(image_tag: str, context_hash: str):
+    try:
+        image = get_docker_client().images.get(image_tag)
+    except docker.errors.ImageNotFound:
+        return None
+    if image.labels.get(CONTEXT_HASH_LABEL) == context_hash:
+        return image
+    return None
 
 
 def build_docker_image(
         image_tag: str,
         docker_file_content: str,
-        context_data: List[Union[ContextFile, ContextDirectory]] = ()
+        context_data: List[Union[ContextFile, ContextDirectory]] = (),
+        base_image_id: str = None,
+        use_cache: bool = True,
+        buildkit: bool = False,
+        use_layer_cache: bool = True,
+        stage: str = None,
+        stage_build_args: Callable[[str], Dict[str, str]] = None
 ):
     """
     Builds docker image with tag *image_tag*.
 
-    Files in *base_dir* will be copied to temporary folder.
-    *docker_file_content* string will be written to Dockerfile located in temporary folder where files from *base_dir*
-    were copied. "docker build" command will be executed in newly created temporary folder.
+    Hash of *docker_file_content*, *context_data* contents and *base_image_id* is stored in image label. If *use_cache*
+    is set and image with same tag and hash already exists, build is skipped.
+
+    Build context is streamed to docker daemon as tar archive, *docker_file_content* is added to it as "Dockerfile" and
+    *context_data* entries are read from their original locations. Remote context files are fetched in parallel
+    through download cache.
+
+    Docker SDK does not support BuildKit, so if *buildkit* is set, context is piped to "docker build" command instead.
 
-    We need this kind of hacks in order to make relative path for commands like "COPY" in Dockerfiles work properly.
+    If *use_layer_cache* is not set, docker does not reuse layers of previous builds, every instruction is executed.
+
+    If *stage* is set, this stage of multi-stage Dockerfile is built first and *stage_build_args* is called with its
+    image tag. Returned build arguments are passed to the build of the whole Dockerfile, which reuses cached layers of
+    the stage even if *use_layer_cache* is not set.
     """
 
-    with TempDirectory() as tmp_dir:
-        LOG.info(
-            f"Building docker image '{image_tag}' with context directory '{tmp_dir.path}'...")
+    context_hash = _get_context_hash(docker_file_content, context_data, base_image_id)
+    if use_cache and _find_cached_image(image_tag, context_hash):
+        LOG.info(f"Image '{image_tag}' is up to date, skipping build")
+        return
 
-        for data in context_data:
-            data.copy_to_context(tmp_dir.path)
+    with METRICS.span("context_prepare", image=image_tag), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_CACHE.max_workers) as executor:
+        for _ in executor.map(lambda context_entry: context_entry.prepare(), context_data):
+            pass
 
-        if DOCKERFILE_LOGGER.isEnabledFor(logging.DEBUG):
-            DOCKERFILE_LOGGER.debug("dockerfile content:")
-            for line in docker_file_content.splitlines():
-                DOCKERFILE_LOGGER.debug(line.rstrip())
+    if DOCKERFILE_LOGGER.isEnabledFor(logging.DEBUG):
+        DOCKERFILE_LOGGER.debug("dockerfile content:")
+        for line in docker_file_content.splitlines():
+            DOCKERFILE_LOGGER.debug(line.rstrip())
+
+    def write_context(tar: tarfile.TarFile):
+        dockerfile_bytes = docker_file_content.encode()
+        dockerfile_info = tarfile.TarInfo("Dockerfile")
+        dockerfile_info.size = len(dockerfile_bytes)
+        dockerfile_info.mtime = int(time.time())
+        tar.addfile(dockerfile_info, io.BytesIO(dockerfile_bytes))
+        for context_entry in context_data:
+            context_entry.add_to_tar(tar)
+
+    def build(tag, **build_kwargs):
+        context_stream = TarStream(write_context, image=image_tag)
+        try:
+            if buildkit:
+                _build_with_buildkit(tag, context_stream, **build_kwargs)
+            else:
+                _build_with_docker_api(tag, context_stream, **build_kwargs)
+        finally:
+            METRICS.add("context_bytes", context_stream.bytes_written, image=image_tag)
+        return context_stream.bytes_written
+
+    LOG.info(f"Building docker image '{image_tag}'{' with BuildKit' if buildkit else ''}...")
+    labels = {CONTEXT_HASH_LABEL: context_hash}
+    build_args = {}
+    try:
+        with METRICS.span("build", image=image_tag):
+            if stage is not None:
+                stage_tag = f"{image_tag}-{stage}"
+                build(stage_tag, target=stage, nocache=not use_layer_cache)
+                try:
+                    build_args = stage_build_args(stage_tag)
+                finally:
+                    # stage layers stay referenced by final image, only temporary tag is removed
+                    get_docker_client().images.remove(stage_tag)
+            # final build has to reuse layers of just built stage
+            context_size = build(
+                image_tag, labels=labels, build_args=build_args, nocache=not use_layer_cache and stage is None
+            )
+    except Exception:
+        LOG.error(f"Failed to build image '{image_tag}'")
+        raise
+    LOG.info(f"Successfully build image '{image_tag}', context size {context_size} bytes")
 
-        dockerfile_path = os.path.join(tmp_dir.path, "Dockerfile")
-        open(dockerfile_path, "w").write(docker_file_content)
 
-        cmd = f'docker build -t {image_tag} -f Dockerfile .'
+class _BuildStepTimer(object):
+    """
+    Records duration of every Dockerfile instruction from "docker build" output as "build_step" span.
+
+    Classic builder prints "Step 3/10 : RUN ..." when step starts, so step lasts until next step starts.
+    BuildKit plain progress prints "#7 [stage-1 3/10] RUN ..." on start and "#7 DONE 1.2s" or "#7 CACHED" on finish.
+    """
 
-        LOG.info(f"Executing '{cmd}' in directory '{tmp_dir.path}'")
-        out, code = ProcessRunner(
-            cmd,
-            cwd=tmp_dir.path
-        ).communicate()
-        if code != 0:
-            LOG.error(f"Failed to build image '{image_tag}'")
-            raise Exception(f"Failed to build image '{image_tag}'")
-        LOG.info(f"Successfully build image '{image_tag}'")
+    _classic_step = re.compile(r"^Step (\d+/\d+) : (.*)$")
+    _buildkit_step = re.compile(r"^#(\d+) \[([^\]]+)\] (.*)$")
+    _buildkit_finish = re.compile(r"^#(\d+) (DONE|CACHED)(?: ([\d.]+)s)?")
+
+    def __init__(self, image_tag: str):
+        self.image_tag = image_tag
+        self.current_step = None
+        self.buildkit_steps = {}
+
+    def feed(self, line: str):
+        match = self._classic_step.match(line)
+        if match:
+            self.finish()
+            self.current_step = (match.group(1), match.group(2), time.perf_counter(), [False])
+            return
+        if self.current_step and "---> Using cache" in line:
+            self.current_step[3][0] = True
+            return
+
+        match = self._buildkit_step.match(line)
+        if match:
+            self.buildkit_steps[match.group(1)] = (match.group(2), match.group(3))
+            return
+        match = self._buildkit_finish.match(line)
+        if match and match.group(1) in self.buildkit_steps:
+            step, instruction = self.buildkit_steps.pop(match.group(1))
+            self._record(step, instruction, float(match.group(3) or 0), match.group(2) == "CACHED")
+
+    def finish(self):
+        if self.current_step:
+            step, instruction, started, cached = self.current_step
+            self._record(step, instruction, time.perf_counter() - started, cached[0])
+            self.current_step = None
+
+    def _record(self, step, instruction, duration, cached):
+        METRICS.record(
+            "build_step",
+            duration,
+            image=self.image_tag,
+            step=step,
+            instruction=instruction[:200],
+            cached=cached
+        )
+
+
+def _build_with_docker_api(image_tag, context_stream, labels=None, target=None, build_args=None, nocache=False):
+    step_timer = _BuildStepTimer(image_tag)
+    for chunk in get_docker_client().api.build(
+            fileobj=context_stream,
+            custom_context=True,
+            tag=image_tag,
+            labels=labels,
+            target=target,
+            buildargs=build_args,
+            nocache=nocache,
+            rm=True,
+            decode=True
+    ):
+        if "stream" in chunk:
+            for line in chunk["stream"].splitlines():
+                if line.strip():
+                    BUILD_LOGGER.debug(f"[{image_tag}] {line.rstrip()}")
+                    step_timer.feed(line.strip())
+        if "error" in chunk:
+            raise Exception(chunk["error"].strip())
+    step_timer.finish()
+
+
+def _build_with_buildkit(image_tag, context_stream, labels=None, target=None, build_args=None, nocache=False):
+    args = [f"--label {shlex.quote(f'{k}={v}')}" for k, v in (labels or {}).items()]
+    args.extend(f"--build-arg {shlex.quote(f'{k}={v}')}" for k, v in (build_args or {}).items())
+    if target is not None:
+        args.append(f"--target {shlex.quote(target)}")
+    if nocache:
+        args.append("--no-cache")
+    cmd = f"docker build --progress=plain -t {shlex.quote(image_tag)} {' '.join(args)} -"
+    LOG.info(f"Executing '{cmd}'")
+    step_timer = _BuildStepTimer(image_tag)
+    out, code = ProcessRunner(
+        cmd,
+        log_prefix=f"[{image_tag}] ",
+        buffer_lines=50,
+        env={"DOCKER_BUILDKIT": "1"},
+        input_stream=context_stream,
+        line_callback=step_timer.feed
+    ).communicate()
+    if code != 0:
+        LOG.error(f"Last 'docker build' output lines:\n{out}")
+        raise Exception(f"'docker build' exited with code {code}")
 
 
 # def build_stack_image(stack_repo_url: str, base_image_name: str = None, **kwargs) -> str:
@@ -197,6 +521,12 @@ def _build_ambari_image(
         packages=(),
         context_data=None,
         image_prefix="crs",
+        use_build_cache=True,
+        buildkit=False,
+        use_layer_cache=True,
+        tag_with_os=False,
+        stage=None,
+        stage_build_args=None,
         **template_arguments
 ):
     """
@@ -209,6 +539,12 @@ def _build_ambari_image(
     :param labels: additional labels to be added to resulting image
     :param env_variables: environment variables to be set
     :param packages: packages to be installed in to image, can not be empty
+    :param use_build_cache: skip build if image with same inputs already exists
+    :param buildkit: build with BuildKit, enables package cache mounts in Dockerfile
+    :param use_layer_cache: reuse docker layers of previous builds
+    :param tag_with_os: add os to image tag, needed when the same build is built for several os
+    :param stage: Dockerfile stage built before the whole Dockerfile, see *build_docker_image*
+    :param stage_build_args: callable that returns build arguments from image built for *stage*
     :param template_arguments: key-value arguments that will be passed to Dockerfile template
 
     :return: resulting image tag
@@ -225,38 +561,40 @@ def _build_ambari_image(
     if not packages:
         raise Exception("Some ambari packages need to be specified")
 
-    url = urllib.parse.urlparse(ambari_repo_url)
-    path_parts = url.path.split('/')
+    repo_os, repo_stack, repo_build = parse_repository_url(ambari_repo_url)
 
-    repo_os, repo_stack, repo_build = path_parts[-4], path_parts[-5], path_parts[-1]
+    resulting_image_tag = f"{image_prefix}/ambari/{component}:{repo_build}"
+    if tag_with_os:
+        resulting_image_tag += f"-{repo_os}"
 
-    possible_urls = [
-        f"{ambari_repo_url.rstrip('/')}/{repo_stack.lower()}bn.repo",
-        f"{ambari_repo_url.rstrip('/')}/{repo_stack.lower()}.repo"
-    ]
+    with METRICS.span("repo_discovery", image=resulting_image_tag):
+        repo_file_url = REPO_FILE_RESOLVER.resolve(ambari_repo_url, repo_stack)
 
-    repo_file_url = None
-    for url in possible_urls:
-        try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                repo_file_url = url
-                break
-        except requests.RequestException:
-            pass
+    if YUM_PROXY.running:
+        template_arguments['yum_options'] = YUM_PROXY.yum_options(repo_file_url)
 
-    if repo_file_url is None:
-        raise Exception("Failed to determine repo file url")
     # create labels
     labels['ambari.repo'] = ambari_repo_url
     labels['ambari.build'] = repo_build
     labels['ambari.os'] = repo_os
     labels[f'ambari.{component}'] = "true"
 
-    base_image_name, labels = _get_base_image_info(base_image_name, repo_os, labels)
-
-    # some os requires additional packages
-    packages = packages + _os_to_packages[repo_os]
+    with METRICS.span("base_image", image=resulting_image_tag):
+        base_image_name, base_image_labels, base_image_id = _get_base_image_info(base_image_name, repo_os, labels)
+        if base_image_labels.get(BASE_IMAGE_LABEL) != "true":
+            base_image_name = _build_ambari_base_image(
+                ambari_repo_url,
+                repo_file_url,
+                base_image_name,
+                image_prefix=image_prefix,
+                use_build_cache=use_build_cache,
+                buildkit=buildkit,
+                use_layer_cache=use_layer_cache
+            )
+            base_image_name, base_image_labels, base_image_id = _get_base_image_info(
+                base_image_name, repo_os, labels
+            )
+        labels = base_image_labels
 
     if labels:
         template_arguments['label'] = " ".join([f'{k}="{v}"' for k, v in labels.items()])
@@ -266,33 +604,118 @@ def _build_ambari_image(
 
     template_arguments['packages'] = packages
     template_arguments['base_image'] = base_image_name
-    template_arguments['repo_file_url'] = repo_file_url
+    template_arguments['buildkit'] = buildkit
 
     template_path = f"templates/dockerfiles/ambari/{_os_to_template_path[repo_os]}/Dockerfile.{component}"
     template_root = TEMPLATE_TOOL.get_template_root(template_path)
-    dockerfile_content = TEMPLATE_TOOL.render(template_path, **template_arguments)
+    with METRICS.span("render", image=resulting_image_tag):
+        dockerfile_content = TEMPLATE_TOOL.render(template_path, **template_arguments)
 
     context_data.append(ContextDirectory(template_root))
-    resulting_image_tag = f"{image_prefix}/ambari/{component}:{repo_build}"
 
     build_docker_image(
         image_tag=resulting_image_tag,
         docker_file_content=dockerfile_content,
-        context_data=context_data
+        context_data=context_data,
+        base_image_id=base_image_id,
+        use_cache=use_build_cache,
+        buildkit=buildkit,
+        use_layer_cache=use_layer_cache,
+        stage=stage,
+        stage_build_args=stage_build_args
     )
 
     return resulting_image_tag
 
 
+def _build_ambari_base_image(
+        ambari_repo_url: str,
+        repo_file_url: str,
+        base_image_name: str,
+        image_prefix="crs",
+        use_build_cache=True,
+        buildkit=False,
+        use_layer_cache=True
+):
+    """
+    Builds image with pip, python packages, supervisor and ambari repository file on top of *base_image_name*.
+
+    Image is tagged per repository build and os, so agent and server images of the same build share it. If
+    *base_image_name* is not default image for os, tag also includes base image id.
+
+    :return: resulting image tag
+    """
+    repo_os, _, repo_build = parse_repository_url(ambari_repo_url)
+
+    labels = {
+        'ambari.repo': ambari_repo_url,
+        'ambari.build': repo_build,
+        'ambari.os': repo_os,
+        BASE_IMAGE_LABEL: "true"
+    }
+    base_image_name, labels, base_image_id = _get_base_image_info(base_image_name, repo_os, labels)
+    # digest of exact base image, inherited by agent and server images
+    base_image_digests = _image_digests(get_docker_client().images.get(base_image_name))
+    if base_image_digests:
+        labels[BASE_IMAGE_DIGEST_LABEL] = f"{base_image_name.split('@')[0]}@{base_image_digests[0]}"
+
+    resulting_image_tag = f"{image_prefix}/ambari/base:{repo_build}-{repo_os}"
+    if base_image_name != OS_BASE_IMAGES[repo_os]:
+        resulting_image_tag += f"-{base_image_id.split(':')[-1][:12]}"
+
+    template_path = f"templates/dockerfiles/ambari/{_os_to_template_path[repo_os]}/Dockerfile.base"
+    with METRICS.span("render", image=resulting_image_tag):
+        dockerfile_content = TEMPLATE_TOOL.render(
+            template_path,
+            label=" ".join([f'{k}="{v}"' for k, v in labels.items()]),
+            base_image=base_image_name,
+            repo_file_url=repo_file_url,
+            # some os requires additional packages
+            packages=_os_to_packages[repo_os],
+            buildkit=buildkit
+        )
+
+    with _base_image_locks_lock:
+        lock = _base_image_locks.setdefault(resulting_image_tag, threading.Lock())
+
+    # agent and server builds can require the same base image at the same time
+    with lock:
+        build_docker_image(
+            image_tag=resulting_image_tag,
+            docker_file_content=dockerfile_content,
+            base_image_id=base_image_id,
+            use_cache=use_build_cache,
+            buildkit=buildkit,
+            use_layer_cache=use_layer_cache
+        )
+
+    return resulting_image_tag
+
+
 def build_ambari_server_image(
         ambari_repo_url: str,
         base_image_name: str = None,
-        mpacks=None
+        mpacks=None,
+        use_build_cache=True,
+        buildkit=False,
+        use_layer_cache=True,
+        tag_with_os=False,
+        prewarm=False,
+        prewarm_timeout=300
 ):
     if mpacks is None:
         mpacks = []
 
     template_arguments = {}
+    labels = {}
+    if prewarm:
+        template_arguments["prewarm"] = True
+        template_arguments["prewarm_timeout"] = prewarm_timeout
+        template_arguments["prewarm_stage"] = PREWARM_STAGE
+        template_arguments["startup_time_file"] = STARTUP_TIME_FILE
+        template_arguments["startup_time_label"] = STARTUP_TIME_LABEL
+        template_arguments["startup_time_build_arg"] = STARTUP_TIME_BUILD_ARG
+        labels["ambari.server.prewarmed"] = "true"
 
     context_data = []
     mpacks_in_container = []
@@ -307,13 +730,14 @@ def build_ambari_server_image(
         mpack_name = os.path.basename(mpack)
         mpack_path = f"/mpacks/{mpack_name}"
         context_data.append(ContextFile(mpack, mpack_path))
+        # all commands are executed in single RUN instruction with postgresql already started
         if purge:
             mpacks_in_container.append(
-                f"systemctl start postgresql; echo yes | ambari-server install-mpack --mpack /root/mpacks/{mpack_name} --purge"
+                f"echo yes | ambari-server install-mpack --mpack /root/mpacks/{mpack_name} --purge"
             )
         else:
             mpacks_in_container.append(
-                f"systemctl start postgresql; ambari-server install-mpack --mpack /root/mpacks/{mpack_name}"
+                f"ambari-server install-mpack --mpack /root/mpacks/{mpack_name}"
             )
     if mpacks_in_container:
         template_arguments["mpacks"] = mpacks_in_container
@@ -324,19 +748,134 @@ def build_ambari_server_image(
         ambari_repo_url,
         base_image_name,
         "server",
+        labels=labels,
         packages=packages,
         context_data=context_data,
+        use_build_cache=use_build_cache,
+        buildkit=buildkit,
+        use_layer_cache=use_layer_cache,
+        tag_with_os=tag_with_os,
+        stage=PREWARM_STAGE if prewarm else None,
+        stage_build_args=_startup_time_build_args if prewarm else None,
         **template_arguments
     )
 
 
+def _startup_time_build_args(stage_image_tag: str) -> Dict[str, str]:
+    """
+    Reads warm startup time measured by prewarm stage from *STARTUP_TIME_FILE* of never started container.
+    """
+    container = get_docker_client().containers.create(stage_image_tag)
+    try:
+        chunks, _ = container.get_archive(STARTUP_TIME_FILE)
+        with tarfile.open(fileobj=io.BytesIO(b"".join(chunks))) as tar:
+            member = tar.next()
+            startup_ms = int(tar.extractfile(member).read().decode().strip())
+    finally:
+        container.remove()
+    METRICS.record("server_startup", startup_ms / 1000, image=stage_image_tag)
+    LOG.info(f"Prewarmed server in '{stage_image_tag}' starts in {startup_ms / 1000:.3f} seconds")
+    return {STARTUP_TIME_BUILD_ARG: f"{startup_ms / 1000:.3f}"}
+
+
 def build_ambari_agent_image(
         ambari_repo_url: str,
-        base_image_name: str = None
+        base_image_name: str = None,
+        use_build_cache=True,
+        buildkit=False,
+        use_layer_cache=True,
+        tag_with_os=False
 ):
     return _build_ambari_image(
         ambari_repo_url,
         base_image_name,
         "agent",
-        packages=("ambari-agent",)
+        packages=("ambari-agent",),
+        use_build_cache=use_build_cache,
+        buildkit=buildkit,
+        use_layer_cache=use_layer_cache,
+        tag_with_os=tag_with_os
     )
+
+
+class BuildTask(object):
+    def __init__(self, name: str, callback: Callable[[Dict[str, str]], str], depends_on: Iterable[str] = ()):
+        """
+        :param name: unique task name, used to reference task from *depends_on* of other tasks
+        :param callback: function that builds image, receives results of finished tasks and returns image tag
+        :param depends_on: names of tasks that must be finished before this task
+        """
+        self.name = name
+        self.callback = callback
+        self.depends_on = tuple(depends_on)
+
+
+class BuildScheduler(object):
+    """
+    Runs image builds respecting dependencies between them.
+
+    Builds that do not depend on each other are executed in parallel, at most *max_workers* at once.
+    """
+
+    def __init__(self, max_workers: int = 2):
+        if max_workers < 1:
+            raise ValueError(f"'max_workers' must be positive, got {max_workers}")
+        self.max_workers = max_workers
+        self.tasks = OrderedDict()
+        self.durations = {}
+
+    def add(self, name: str, callback: Callable[[Dict[str, str]], str], depends_on: Iterable[str] = ()):
+        if name in self.tasks:
+            raise Exception(f"Build task '{name}' already scheduled")
+        self.tasks[name] = BuildTask(name, callback, depends_on)
+        return self
+
+    def _check_dependencies(self):
+        for task in self.tasks.values():
+            for dependency in task.depends_on:
+                if dependency not in self.tasks:
+                    raise Exception(f"Build task '{task.name}' depends on unknown task '{dependency}'")
+
+    def _run_task(self, task: BuildTask, results: Dict[str, str]):
+        started = time.perf_counter()
+        try:
+            return task.callback(results)
+        finally:
+            self.durations[task.name] = time.perf_counter() - started
+
+    def run(self) -> Dict[str, str]:
+        """
+        Executes all scheduled tasks.
+
+        :return: mapping of task name to resulting image tag
+        """
+        self._check_dependencies()
+
+        results = {}
+        pending = OrderedDict(self.tasks)
+        running = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name, task in list(pending.items()):
+                    if all(dependency in results for dependency in task.depends_on):
+                        LOG.info(f"Starting build task '{name}'")
+                        running[executor.submit(self._run_task, task, dict(results))] = name
+                        del pending[name]
+
+                if not running:
+                    raise Exception(f"Build tasks have circular dependencies: {', '.join(pending)}")
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception:
+                        LOG.error(f"Build task '{name}' failed, waiting for running tasks to finish")
+                        for other in running:
+                            other.cancel()
+                        raise
+                    LOG.info(f"Build task '{name}' finished")
+
+        return results
@@ -0,0 +1,141 @@
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+
+
+class Span(object):
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes
+        }
+
+
+class Metrics(object):
+    """
+    Collects timings of pipeline stages as spans and arbitrary numeric counters.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = []
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        span = Span(name, attributes)
+        started = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - started
+            with self._lock:
+                self.spans.append(span)
+
+    def record(self, name: str, duration: float, **attributes):
+        """
+        Adds span that was timed outside of *span* context manager.
+        """
+        span = Span(name, attributes)
+        span.start -= duration
+        span.duration = duration
+        with self._lock:
+            self.spans.append(span)
+
+    def add(self, name: str, value, **attributes):
+        key = (name, tuple(sorted(attributes.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+            self.counters = {}
+
+    def export(self, path: str, export_format: str = "jsonl"):
+        exporters = {
+            "jsonl": self._export_jsonl,
+            "prometheus": self._export_prometheus
+        }
+        if export_format not in exporters:
+            raise ValueError(f"Unknown metrics format '{export_format}'")
+        with self._lock:
+            spans, counters = list(self.spans), dict(self.counters)
+        # write to temporary file first, so collectors never read partially written file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            exporters[export_format](f, spans, counters)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _export_jsonl(f, spans, counters):
+        for span in spans:
+            f.write(json.dumps(dict(type="span", **span.to_dict())))
+            f.write("\n")
+        for (name, attributes), value in counters.items():
+            f.write(json.dumps({"type": "counter", "name": name, "value": value, "attributes": dict(attributes)}))
+            f.write("\n")
+
+    @staticmethod
+    def _export_prometheus(f, spans, counters):
+        durations = {}
+        counts = {}
+        for span in spans:
+            key = (span.name, tuple(sorted(
+                (k, v) for k, v in span.attributes.items() if k in _prometheus_span_labels
+            )))
+            durations[key] = durations.get(key, 0) + span.duration
+            counts[key] = counts.get(key, 0) + 1
+
+        f.write("# HELP ambari_docker_stage_duration_seconds Time spent in pipeline stage\n")
+        f.write("# TYPE ambari_docker_stage_duration_seconds gauge\n")
+        for (name, attributes), duration in sorted(durations.items()):
+            f.write(f"ambari_docker_stage_duration_seconds{_prometheus_labels(stage=name, **dict(attributes))}"
+                    f" {duration:.6f}\n")
+        f.write("# HELP ambari_docker_stage_count Number of times pipeline stage was executed\n")
+        f.write("# TYPE ambari_docker_stage_count gauge\n")
+        for (name, attributes), count in sorted(counts.items()):
+            f.write(f"ambari_docker_stage_count{_prometheus_labels(stage=name, **dict(attributes))} {count}\n")
+
+        for name in sorted({name for name, _ in counters}):
+            metric_name = f"ambari_docker_{_prometheus_name(name)}"
+            f.write(f"# TYPE {metric_name} gauge\n")
+            for (counter_name, attributes), value in sorted(counters.items()):
+                if counter_name == name:
+                    f.write(f"{metric_name}{_prometheus_labels(**dict(attributes))} {value}\n")
+
+
+# span attributes with low cardinality that are exported as prometheus labels
+_prometheus_span_labels = ("command", "image", "step", "url", "cached", "template")
+
+
+def _prometheus_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _prometheus_label_value(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prometheus_labels(**labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        f'{_prometheus_name(k)}="{_prometheus_label_value(v)}"' for k, v in sorted(labels.items())
+    ) + "}"
+
+
+METRICS = Metrics()
@@ -0,0 +1,150 @@
+import posixpath
+from typing import Dict, Iterable, List
+
+from ambari_docker.utils import parse_size
+
+
+class DockerHost(object):
+    """
+    Docker host with memory and cpu capacity available for cluster nodes.
+    """
+
+    def __init__(self, name: str, memory: int, cpus: float):
+        self.name = name
+        self.memory = memory
+        self.cpus = cpus
+        self.nodes = []
+        self.used_memory = 0
+        self.used_cpus = 0.0
+
+    @staticmethod
+    def parse(spec: str) -> "DockerHost":
+        """
+        Parses host specification in 'name:MEMORY:CPUS' format, e.g. 'docker-1:64G:16'.
+        """
+        parts = spec.rsplit(":", 2)
+        if len(parts) != 3 or not parts[0]:
+            raise ValueError(f"'{spec}' is not a valid host, expected 'name:MEMORY:CPUS'")
+        name, memory, cpus = parts
+        return DockerHost(name, parse_size(memory), float(cpus))
+
+    def fits(self, memory: int, cpus: float) -> bool:
+        return self.used_memory + memory <= self.memory and self.used_cpus + cpus <= self.cpus
+
+    def add(self, node: str, memory: int, cpus: float):
+        self.nodes.append(node)
+        self.used_memory += memory
+        self.used_cpus += cpus
+
+    def utilization(self):
+        """
+        :return: tuple of memory and cpu utilization, from 0 to 1
+        """
+        return (
+            self.used_memory / self.memory if self.memory else 0.0,
+            self.used_cpus / self.cpus if self.cpus else 0.0
+        )
+
+
+def place_nodes(hosts: List[DockerHost], nodes: Iterable[str], memory: int, cpus: float) -> Dict[str, DockerHost]:
+    """
+    Places *nodes* on *hosts* with first fit bin packing, every node reserves the same *memory* and *cpus*.
+    Hosts are tried from the biggest to the smallest, so small hosts stay free when cluster fits on big ones.
+
+    :return: mapping of node name to host
+    """
+    ordered_hosts = sorted(hosts, key=lambda h: (h.memory, h.cpus), reverse=True)
+    placement = {}
+    for node in nodes:
+        host = next((h for h in ordered_hosts if h.fits(memory, cpus)), None)
+        if host is None:
+            raise Exception(f"Node '{node}' does not fit on any host, {len(placement)} nodes placed so far")
+        host.add(node, memory, cpus)
+        placement[node] = host
+    return placement
+
+
+# agent copy of stack scripts downloaded from server, the same on every node
+STACK_CACHE_PATH = "/var/lib/ambari-agent/cache"
+
+
+class DataMounts(object):
+    """
+    Data directories of cluster nodes placed outside of container overlay filesystem.
+
+    :param suffix: cluster suffix, volume names are prefixed with it
+    :param tmpfs: 'PATH[:SIZE]' specifications of directories on tmpfs, size is charged to node memory limit
+    :param volumes: directories on named volumes, every node gets own volume
+    :param shared_stack_cache: mount one volume to agent stack cache of all nodes, writable by server node only
+    """
+
+    def __init__(self, suffix: str, tmpfs: Iterable[str] = (), volumes: Iterable[str] = (),
+                 shared_stack_cache: bool = False):
+        self.suffix = suffix
+        self.tmpfs = [self.parse_tmpfs(spec) for spec in tmpfs]
+        self.volumes = [self._normalize(path) for path in volumes]
+        self.shared_stack_cache = shared_stack_cache
+
+        paths = [path for path, _ in self.tmpfs] + self.volumes
+        if shared_stack_cache:
+            paths.append(STACK_CACHE_PATH)
+        for path in paths:
+            if not path.startswith("/"):
+                raise ValueError(f"'{path}' is not an absolute path")
+        duplicates = sorted({path for path in paths if paths.count(path) > 1})
+        if duplicates:
+            raise ValueError(f"Directories can be placed only once: {', '.join(duplicates)}")
+
+    @staticmethod
+    def _normalize(path: str) -> str:
+        # '/var/log/' and '/var/log' are the same mount point for docker
+        return posixpath.normpath(path) if path else path
+
+    @staticmethod
+    def parse_tmpfs(spec: str):
+        """
+        Parses 'PATH[:SIZE]' specification, e.g. '/hadoop:4G'.
+
+        :return: tuple of path and size in bytes or None
+        """
+        path, _, size = spec.partition(":")
+        return DataMounts._normalize(path), parse_size(size) if size else None
+
+    def __bool__(self):
+        return bool(self.tmpfs or self.volumes or self.shared_stack_cache)
+
+    @property
+    def stack_cache_volume(self) -> str:
+        return f"{self.suffix}-stack-cache"
+
+    def volume_name(self, node: str, path: str) -> str:
+        return f"{self.suffix}-{node}-{path.strip('/').replace('/', '-')}"
+
+    def node_tmpfs(self) -> Dict[str, str]:
+        """
+        :return: mapping of directory to tmpfs mount options
+        """
+        # ambari runs scripts from data directories, docker mounts tmpfs with 'noexec' by default
+        return {
+            path: f"exec,size={size}" if size else "exec"
+            for path, size in self.tmpfs
+        }
+
+    def node_volumes(self, node: str, role: str) -> List[tuple]:
+        """
+        :return: list of volume name, directory and mode tuples for *node* with *role*
+        """
+        volumes = [(self.volume_name(node, path), path, "rw") for path in self.volumes]
+        if self.shared_stack_cache:
+            volumes.append((self.stack_cache_volume, STACK_CACHE_PATH, "rw" if role == "server" else "ro"))
+        return volumes
+
+    def volume_names(self, nodes: Iterable[str]) -> Iterable[str]:
+        """
+        Lazily yields names of all volumes used by *nodes*.
+        """
+        if self.shared_stack_cache:
+            yield self.stack_cache_volume
+        for node in nodes:
+            for path in self.volumes:
+                yield self.volume_name(node, path)
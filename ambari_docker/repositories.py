@@ -0,0 +1,116 @@
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from ambari_docker.config import CACHE_ROOT
+from ambari_docker.metrics import METRICS
+from ambari_docker.utils import http_session, HTTP_TIMEOUT
+
+LOG = logging.getLogger("RepoFileResolver")
+
+
+class RepoFileResolver(object):
+    """
+    Finds yum repo file url for ambari repository.
+
+    Candidate urls are probed concurrently with HEAD requests, result is remembered for the lifetime of the process.
+    If *ttl* is positive, results are also stored in *cache_file* and reused by other processes for *ttl* seconds.
+    """
+
+    def __init__(self, cache_file: str = os.path.join(CACHE_ROOT, "repo-files.json"), ttl: int = 0):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self._resolved = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def configure(self, cache_file: str = None, ttl: int = None):
+        if cache_file is not None:
+            self.cache_file = cache_file
+        if ttl is not None:
+            self.ttl = ttl
+
+    @staticmethod
+    def candidates(ambari_repo_url: str, repo_stack: str):
+        return [
+            f"{ambari_repo_url.rstrip('/')}/{repo_stack.lower()}bn.repo",
+            f"{ambari_repo_url.rstrip('/')}/{repo_stack.lower()}.repo"
+        ]
+
+    def resolve(self, ambari_repo_url: str, repo_stack: str) -> str:
+        with self._lock:
+            repo_lock = self._locks.setdefault(ambari_repo_url, threading.Lock())
+
+        with repo_lock:
+            if ambari_repo_url not in self._resolved:
+                repo_file_url = self._read_disk_cache(ambari_repo_url)
+                if repo_file_url is None:
+                    repo_file_url = self._probe_candidates(self.candidates(ambari_repo_url, repo_stack))
+                    self._write_disk_cache(ambari_repo_url, repo_file_url)
+                self._resolved[ambari_repo_url] = repo_file_url
+            return self._resolved[ambari_repo_url]
+
+    @staticmethod
+    def _probe(url: str) -> bool:
+        with METRICS.span("repo_probe", url=url):
+            return RepoFileResolver._probe_url(url)
+
+    @staticmethod
+    def _probe_url(url: str) -> bool:
+        try:
+            response = http_session().head(url, allow_redirects=True, timeout=HTTP_TIMEOUT)
+            if response.status_code in (403, 405, 501):
+                # some mirrors do not support HEAD
+                with http_session().get(url, stream=True, timeout=HTTP_TIMEOUT) as get_response:
+                    return get_response.status_code == 200
+            return response.status_code == 200
+        except requests.RequestException as e:
+            LOG.debug(f"Failed to probe '{url}': {e}")
+            return False
+
+    def _probe_candidates(self, candidates):
+        LOG.info(f"Looking for repo file in {candidates}")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+            # first available candidate wins, order of candidates defines priority
+            for url, available in zip(candidates, executor.map(self._probe, candidates)):
+                if available:
+                    LOG.info(f"Found repo file '{url}'")
+                    return url
+        raise Exception("Failed to determine repo file url")
+
+    def _read_disk_cache(self, ambari_repo_url):
+        if self.ttl <= 0:
+            return None
+        try:
+            with open(self.cache_file) as f:
+                entry = json.load(f).get(ambari_repo_url)
+        except (OSError, ValueError):
+            return None
+        if entry and time.time() - entry["time"] < self.ttl:
+            LOG.info(f"Using cached repo file url '{entry['repo_file_url']}'")
+            return entry["repo_file_url"]
+        return None
+
+    def _write_disk_cache(self, ambari_repo_url, repo_file_url):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            try:
+                with open(self.cache_file) as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                entries = {}
+            entries[ambari_repo_url] = {"repo_file_url": repo_file_url, "time": time.time()}
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            tmp_path = f"{self.cache_file}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.cache_file)
+
+
+REPO_FILE_RESOLVER = RepoFileResolver()
@@ -1,80 +1,302 @@
+import collections
 import logging
 import os
-import shutil
+import selectors
+import signal
 import subprocess
 import sys
-import tempfile
+import tarfile
 import threading
-import uuid
+import time
 
-import requests
+from ambari_docker.metrics import METRICS
 
+# (connect, read) timeout for all http requests made through shared session
+HTTP_TIMEOUT = (10, 60)
 
-def copy_tree(src, dst, symlinks=False, ignore=None):
-    for item in os.listdir(src):
-        s = os.path.join(src, item)
-        d = os.path.join(dst, item)
-        if os.path.isdir(s):
-            shutil.copytree(s, d, symlinks, ignore)
-        else:
-            shutil.copy2(s, d)
+_http_session = None
+_http_session_lock = threading.Lock()
 
 
-def copy_file(src, dst):
-    if os.path.isfile(src):
-        shutil.copy(src, dst)
-    else:
-        raise ValueError(f"'{src}' is not a file")
+def hash_file(hasher, file_path, chunk_size=1024 * 1024):
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
 
 
-def download_file(url, destination):
-    r = requests.get(url, stream=True)
-    with open(destination, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
+def hash_tree(hasher, root):
+    """
+    Updates *hasher* with relative paths, permissions and contents of all files under *root* in a stable order.
+    """
+    for directory, directories, files in os.walk(root):
+        directories.sort()
+        for name in sorted(files):
+            file_path = os.path.join(directory, name)
+            hasher.update(os.path.relpath(file_path, root).encode())
+            hasher.update(oct(os.stat(file_path).st_mode & 0o777).encode())
+            hash_file(hasher, file_path)
 
 
-class TempDirectory(object):
-    def __init__(self):
-        self.path = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
+def http_session() -> "requests.Session":
+    """
+    Returns process-wide session, connections to the same host are pooled and reused between requests.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            # imported on first use, commands without network access do not pay for requests import
+            import requests
+            import requests.adapters
 
-    def __enter__(self):
-        os.mkdir(self.path)
-        return self
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        try:
-            shutil.rmtree(self.path, ignore_errors=True)
-        except:
-            pass
+
+_size_suffixes = {
+    "": 1,
+    "K": 1024,
+    "M": 1024 ** 2,
+    "G": 1024 ** 3,
+    "T": 1024 ** 4
+}
+
+
+def parse_size(value: str) -> int:
+    """
+    Converts size strings like '512M' or '10G' to bytes.
+    """
+    value = str(value).strip().upper().rstrip("B")
+    suffix = value[-1:] if value[-1:] in _size_suffixes else ""
+    number = value[:len(value) - len(suffix)]
+    try:
+        return int(float(number) * _size_suffixes[suffix])
+    except ValueError:
+        raise ValueError(f"'{value}' is not a valid size")
+
+
+class TarStream(object):
+    """
+    Iterable over chunks of tar archive, archive content is written by *writer* callable in background thread.
+
+    Archive is never stored, only one chunk is kept in memory at once. Time between first and last chunk is recorded
+    as "context_copy" span with *span_attributes*.
+    """
+
+    def __init__(self, writer, chunk_size=1024 * 1024, **span_attributes):
+        self.writer = writer
+        self.chunk_size = chunk_size
+        self.span_attributes = span_attributes
+        self.bytes_written = 0
+
+    def __iter__(self):
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def produce():
+            pipe = open(write_fd, "wb")
+            try:
+                with tarfile.open(fileobj=pipe, mode="w|") as tar:
+                    self.writer(tar)
+                pipe.close()
+            except BrokenPipeError:
+                # consumer stopped reading, nothing to report
+                pass
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        with METRICS.span("context_copy", **self.span_attributes), open(read_fd, "rb") as pipe:
+            for chunk in iter(lambda: pipe.read(self.chunk_size), b""):
+                self.bytes_written += len(chunk)
+                yield chunk
+        producer.join()
+        if errors:
+            raise errors[0]
 
 
 class ProcessRunner(object):
+    """
+    Runs shell command and streams its output line by line to log as soon as it arrives.
+
+    Only last *buffer_lines* lines of output are kept in memory. Process is terminated if it runs longer than *timeout*
+    seconds or if *cancel* is called. Output of many processes can be handled by single thread with *run_processes*.
+    """
     LOG = logging.getLogger("ProcessRunner")
 
+    # seconds to wait after SIGTERM before killing process
+    TERMINATE_GRACE_PERIOD = 10
+
     def __init__(
             self,
             command_line: str,
-            cwd: str = None
+            cwd: str = None,
+            log_prefix: str = "",
+            env: dict = None,
+            input_stream=None,
+            line_callback=None,
+            buffer_lines: int = 1000,
+            timeout: float = None
     ):
+        """
+        :param input_stream: iterable of bytes chunks, written to process stdin
+        :param line_callback: function called with every output line
+        :param buffer_lines: count of last output lines to keep
+        :param timeout: seconds after which process is terminated
+        """
+        self.command_line = command_line
+        self.log_prefix = log_prefix
+        self.line_callback = line_callback
+        self.lines = collections.deque(maxlen=buffer_lines)
+        self.timeout = timeout
+        self.timed_out = False
+        self._cancelled = threading.Event()
+        self._terminated_at = None
+        self._partial_line = b""
+        self._input = iter(input_stream) if input_stream is not None else None
+        self._pending_input = b""
+        self._started_at = time.monotonic()
         self.process = subprocess.Popen(
             command_line,
             stderr=subprocess.STDOUT,
             stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE if input_stream is not None else None,
             shell=True,
-            cwd=cwd
+            cwd=cwd,
+            env=dict(os.environ, **env) if env else None,
+            # own process group, so whole shell pipeline can be terminated at once
+            start_new_session=True
         )
         self.stream = self.process.stdout
+        os.set_blocking(self.process.stdout.fileno(), False)
+        if self._input is not None:
+            os.set_blocking(self.process.stdin.fileno(), False)
+
+    def cancel(self):
+        """
+        Requests process termination, safe to call from any thread.
+        """
+        self._cancelled.set()
 
     def communicate(self):
-        data = ""
-        while self.process.poll() is None:
-            line = self.stream.readline().decode()
-            if self.LOG.isEnabledFor(logging.DEBUG):
-                self.LOG.debug(line.rstrip())
-            data += line
-        return data, self.process.returncode
+        """
+        Waits for process to finish.
+
+        :return: last lines of process output and exit code
+        """
+        return run_processes([self])[0]
+
+    def _register(self, selector):
+        selector.register(self.process.stdout, selectors.EVENT_READ, self)
+        if self._input is not None:
+            selector.register(self.process.stdin, selectors.EVENT_WRITE, self)
+
+    def _handle(self, selector, file_object):
+        if file_object is self.process.stdout:
+            self._read(selector)
+        else:
+            self._write(selector)
+
+    def _read(self, selector):
+        try:
+            chunk = os.read(self.process.stdout.fileno(), 64 * 1024)
+        except BlockingIOError:
+            return
+        if not chunk:
+            selector.unregister(self.process.stdout)
+            if self._partial_line:
+                self._emit(self._partial_line)
+                self._partial_line = b""
+            return
+        *lines, self._partial_line = (self._partial_line + chunk).split(b"\n")
+        for line in lines:
+            self._emit(line)
+
+    def _emit(self, raw_line: bytes):
+        line = raw_line.decode(errors="replace").rstrip()
+        if self.LOG.isEnabledFor(logging.DEBUG):
+            self.LOG.debug(f"{self.log_prefix}{line}")
+        if self.line_callback:
+            self.line_callback(line)
+        self.lines.append(line)
+
+    def _close_input(self, selector):
+        selector.unregister(self.process.stdin)
+        self._input = None
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+    def _write(self, selector):
+        try:
+            if not self._pending_input:
+                self._pending_input = next(self._input, b"")
+                if not self._pending_input:
+                    self._close_input(selector)
+                    return
+            written = os.write(self.process.stdin.fileno(), self._pending_input)
+            self._pending_input = self._pending_input[written:]
+        except BlockingIOError:
+            pass
+        except BrokenPipeError:
+            self._close_input(selector)
+
+    def _check_deadline(self):
+        now = time.monotonic()
+        if self._terminated_at is None:
+            if self.timeout is not None and now - self._started_at > self.timeout:
+                self.timed_out = True
+            if self.timed_out or self._cancelled.is_set():
+                self.LOG.warning(f"{self.log_prefix}Terminating '{self.command_line}'")
+                self._terminated_at = now
+                self._signal(signal.SIGTERM)
+        elif now - self._terminated_at > self.TERMINATE_GRACE_PERIOD:
+            self._signal(signal.SIGKILL)
+
+    def _signal(self, signal_number):
+        try:
+            os.killpg(self.process.pid, signal_number)
+        except ProcessLookupError:
+            pass
+
+    def _result(self):
+        self.process.wait()
+        if self.timed_out:
+            raise TimeoutError(f"'{self.command_line}' did not finish in {self.timeout} seconds")
+        return "\n".join(self.lines), self.process.returncode
+
+
+def run_processes(runners, poll_interval: float = 0.5):
+    """
+    Handles input and output of all *runners* in current thread until all processes finish.
+
+    :return: list of (last output lines, exit code) in order of *runners*
+    """
+    with selectors.DefaultSelector() as selector:
+        for runner in runners:
+            runner._register(selector)
+        try:
+            while selector.get_map():
+                for key, _ in selector.select(timeout=poll_interval):
+                    key.data._handle(selector, key.fileobj)
+                for runner in runners:
+                    runner._check_deadline()
+        except BaseException:
+            # processes live in their own process groups and do not get Ctrl+C, do not leave them behind
+            for runner in runners:
+                runner._signal(signal.SIGKILL)
+            raise
+    return [runner._result() for runner in runners]
 
 
 class StdOutHandler(logging.Handler):
@@ -0,0 +1,213 @@
+import configparser
+import hashlib
+import http.server
+import logging
+import os
+import shutil
+import threading
+import urllib.parse
+
+from ambari_docker.config import CACHE_ROOT
+from ambari_docker.downloads import DownloadCache
+from ambari_docker.metrics import METRICS
+from ambari_docker.utils import http_session, HTTP_TIMEOUT
+
+LOG = logging.getLogger("YumProxy")
+
+# repository metadata that changes in place, every other repodata file has checksum in its name
+_MUTABLE_FILES = ("repomd.xml", "repomd.xml.asc", "repomd.xml.key")
+
+
+def _is_immutable(path: str) -> bool:
+    """
+    Checks if file under repository url never changes, so cached copy can be used without revalidation.
+    """
+    name = path.rsplit("/", 1)[-1]
+    if name.endswith((".rpm", ".drpm")):
+        return True
+    return "/repodata/" in f"/{path}" and name not in _MUTABLE_FILES
+
+
+class _ProxyRequestHandler(http.server.BaseHTTPRequestHandler):
+    server_version = "AmbariDockerYumProxy"
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def _serve(self, head):
+        upstream_url = self.server.proxy.upstream_url(self.path)
+        if upstream_url is None:
+            self.send_error(404, "Unknown repository")
+            return
+        proxy = self.server.proxy
+        try:
+            # HEAD of file that is not cached yet is answered by upstream, file is downloaded only on GET
+            if _is_immutable(urllib.parse.urlparse(upstream_url).path) and \
+                    (not head or proxy.cache.is_cached(upstream_url)):
+                self._send_cached(upstream_url, head)
+            else:
+                self._send_upstream(upstream_url, head)
+        except Exception as e:
+            LOG.warning(f"Failed to serve '{upstream_url}': {e}")
+            self.send_error(502, "Upstream request failed")
+
+    def _send_cached(self, upstream_url, head):
+        if head:
+            data_path = self.server.proxy.cache.fetch(upstream_url, revalidate=False)
+        else:
+            data_path = self.server.proxy.fetch(upstream_url)
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(data_path)))
+        self.end_headers()
+        if not head:
+            with open(data_path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+    def _send_upstream(self, upstream_url, head):
+        method = "HEAD" if head else "GET"
+        # body is passed as is, so encodings accepted by client are requested and Content-Encoding is forwarded
+        headers = {"Accept-Encoding": self.headers.get("Accept-Encoding", "identity")}
+        with http_session().request(
+                method, upstream_url, headers=headers, stream=True, timeout=HTTP_TIMEOUT
+        ) as response:
+            self.send_response(response.status_code)
+            for header in ("Content-Type", "Content-Length", "Content-Encoding", "Last-Modified", "ETag"):
+                if header in response.headers:
+                    self.send_header(header, response.headers[header])
+            self.end_headers()
+            if not head:
+                for chunk in response.raw.stream(64 * 1024, decode_content=False):
+                    self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        LOG.debug(f"{self.address_string()} {format % args}")
+
+
+class _ProxyServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, proxy):
+        super().__init__(server_address, _ProxyRequestHandler)
+        self.proxy = proxy
+
+
+class YumProxy(object):
+    """
+    Caching http proxy for yum repositories used by image builds.
+
+    Repository base urls are registered in proxy and passed to yum in build containers with '--setopt', so packages
+    are downloaded through proxy transparently. Packages and checksum-named metadata files are immutable and stored
+    in *directory* without revalidation, repomd.xml is always requested from upstream. Least recently used files are
+    removed when cache size exceeds *max_size*.
+    """
+
+    def __init__(
+            self,
+            directory: str = os.path.join(CACHE_ROOT, "yum"),
+            max_size: int = 20 * 1024 ** 3,
+            port: int = 3142
+    ):
+        self.cache = DownloadCache(directory=directory, max_size=max_size)
+        self.port = port
+        self.host = None
+        self.hits = 0
+        self.misses = 0
+        self._upstreams = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def configure(self, directory: str = None, max_size: int = None, port: int = None):
+        self.cache.configure(directory=directory, max_size=max_size)
+        if port is not None:
+            self.port = port
+
+    @property
+    def running(self) -> bool:
+        return self._server is not None
+
+    def start(self, host: str):
+        """
+        Starts proxy in background thread.
+
+        :param host: address of this host as seen from build containers, proxy listens only on this address
+        """
+        self.host = host
+        self._server = _ProxyServer((host, self.port), self)
+        threading.Thread(target=self._server.serve_forever, name="yum-proxy", daemon=True).start()
+        LOG.info(f"Yum proxy listens on {host}:{self.port}, cache directory '{self.cache.directory}'")
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0
+        LOG.info(f"Yum proxy served {self.hits} of {total} cacheable files from cache, hit rate {hit_rate:.1f}%")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def register(self, upstream_url: str) -> str:
+        """
+        Returns url that proxies repository *upstream_url*.
+        """
+        upstream_url = upstream_url.rstrip("/") + "/"
+        key = hashlib.sha1(upstream_url.encode()).hexdigest()[:12]
+        with self._lock:
+            self._upstreams[key] = upstream_url
+        return f"http://{self.host}:{self.port}/{key}/"
+
+    def upstream_url(self, path: str):
+        key, _, rest = path.lstrip("/").partition("/")
+        with self._lock:
+            upstream = self._upstreams.get(key)
+        if upstream is None:
+            return None
+        return upstream + rest
+
+    def fetch(self, upstream_url: str) -> str:
+        is_cached = self.cache.is_cached(upstream_url)
+        data_path = self.cache.fetch(upstream_url, revalidate=False)
+        with self._lock:
+            if is_cached:
+                self.hits += 1
+            else:
+                self.misses += 1
+        METRICS.add("yum_proxy_hits" if is_cached else "yum_proxy_misses", 1)
+        return data_path
+
+    def yum_options(self, repo_file_url: str) -> str:
+        """
+        Downloads repo file and returns yum options that redirect its repositories to proxy.
+
+        Repositories with mirror lists or yum variables in base url are left as is.
+        """
+        response = http_session().get(repo_file_url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            parser.read_string(response.text)
+        except configparser.Error as e:
+            LOG.warning(f"Failed to parse repo file '{repo_file_url}', packages are not proxied: {e}")
+            return ""
+
+        options = []
+        for repo_id in parser.sections():
+            base_urls = parser[repo_id].get("baseurl", "").replace(",", " ").split()
+            if not base_urls or any("$" in url for url in base_urls):
+                LOG.debug(f"Repository '{repo_id}' from '{repo_file_url}' is not proxied")
+                continue
+            proxy_urls = ",".join(self.register(url) for url in base_urls)
+            options.append(f"--setopt={repo_id}.baseurl={proxy_urls}")
+        return " ".join(options)
+
+
+YUM_PROXY = YumProxy()
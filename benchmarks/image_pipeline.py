@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Benchmark for ambari image build pipeline.
+
+"run" command builds agent and server images against local stand-ins: a "registry:2" container that serves base image
+and http server that serves ambari repository mirror from local folder. Every run is a cold build, images produced by
+previous runs are removed and docker layer cache is not used. Per-stage timings, build context size and resulting image
+layer sizes are written to json file.
+
+"compare" command compares two json files produced by "run" and fails if some stage became slower than threshold.
+
+Example:
+    python benchmarks/image_pipeline.py run --repo-dir /srv/mirror \
+        --repo-path ambari/centos7/2.x/BUILDS/2.7.0.0-1 -o before.json
+    python benchmarks/image_pipeline.py compare before.json after.json
+"""
+import functools
+import http.server
+import json
+import logging
+import platform
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import click
+import docker.errors
+
+REGISTRY_CONTAINER_NAME = "ambari-docker-benchmark-registry"
+# repository of all images built by benchmark, including base images and temporary stage tags
+BUILT_IMAGES_REFERENCE = "crs/ambari/*"
+
+LOG = logging.getLogger("Benchmark")
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class RepoServer(object):
+    def __init__(self, directory: str, port: int):
+        handler = functools.partial(_QuietHandler, directory=directory)
+        self.server = http.server.ThreadingHTTPServer(("0.0.0.0", port), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class LocalRegistry(object):
+    def __init__(self, docker_client, port: int, timeout: float = 30):
+        self.docker_client = docker_client
+        self.port = port
+        self.timeout = timeout
+        self.container = None
+
+    def _wait_until_ready(self):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                with urllib.request.urlopen(f"http://localhost:{self.port}/v2/", timeout=5) as response:
+                    if response.status == 200:
+                        return
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            if time.time() > deadline:
+                raise Exception(f"Registry did not start in {self.timeout} seconds")
+            time.sleep(0.2)
+
+    def __enter__(self):
+        self.container = self.docker_client.containers.run(
+            "registry:2",
+            name=REGISTRY_CONTAINER_NAME,
+            ports={"5000/tcp": self.port},
+            detach=True,
+            remove=True
+        )
+        try:
+            self._wait_until_ready()
+        except Exception:
+            self.container.stop()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.container.stop()
+
+    def publish(self, image_name: str) -> str:
+        """
+        Pushes *image_name* to registry and removes local copy, so build has to pull it.
+        """
+        repository, _, tag = image_name.partition(":")
+        registry_repository = f"localhost:{self.port}/{repository}"
+        image = self.docker_client.images.get(image_name)
+        image.tag(registry_repository, tag or "latest")
+        self.docker_client.images.push(registry_repository, tag or "latest")
+        self.docker_client.images.remove(f"{registry_repository}:{tag or 'latest'}")
+        return f"{registry_repository}:{tag or 'latest'}"
+
+
+def _layer_sizes(docker_client, image_tag):
+    return [
+        {"created_by": layer["CreatedBy"], "size": layer["Size"]}
+        for layer in docker_client.api.history(image_tag)
+    ]
+
+
+def _remove_built_images(docker_client):
+    for image in docker_client.images.list(filters={"reference": BUILT_IMAGES_REFERENCE}):
+        for tag in image.tags:
+            try:
+                docker_client.images.remove(tag, force=True)
+            except docker.errors.NotFound:
+                pass
+
+
+def _run_once(image_builder, metrics, repository, base_image, include_agent):
+    _remove_built_images(image_builder.get_docker_client())
+    metrics.reset()
+    started = time.perf_counter()
+    agent_image = image_builder.build_ambari_agent_image(
+        repository, base_image, use_build_cache=False, use_layer_cache=False
+    )
+    server_image = image_builder.build_ambari_server_image(
+        repository, agent_image if include_agent else base_image, use_build_cache=False, use_layer_cache=False
+    )
+    total = time.perf_counter() - started
+
+    stages = {}
+    for span in metrics.spans:
+        key = f"{span.attributes.get('image')}:{span.name}"
+        stages[key] = stages.get(key, 0) + span.duration
+    context_bytes = {
+        dict(attributes)["image"]: value
+        for (name, attributes), value in metrics.counters.items()
+        if name == "context_bytes"
+    }
+    return {
+        "total": total,
+        "stages": stages,
+        "context_bytes": context_bytes,
+        "layers": {
+            image: _layer_sizes(image_builder.get_docker_client(), image)
+            for image in (agent_image, server_image)
+        }
+    }
+
+
+@click.group()
+def cli():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)-15s [%(levelname)s] [%(name)s] %(message)s')
+
+
+@cli.command()
+@click.option("--repo-dir", required=True, type=click.Path(exists=True, file_okay=False),
+              help="local folder with ambari repository mirror")
+@click.option("--repo-path", required=True,
+              help="repository path inside '--repo-dir', e.g. ambari/centos7/2.x/BUILDS/2.7.0.0-1")
+@click.option("--repo-port", default=8765, show_default=True, type=click.INT)
+@click.option("--registry-port", default=5555, show_default=True, type=click.INT)
+@click.option("--base-image", default="centos:7", show_default=True,
+              help="base image, pushed to local registry before benchmark")
+@click.option("+agent/-agent", "include_agent", default=True, show_default=True)
+@click.option("--runs", default=1, show_default=True, type=click.IntRange(min=1))
+@click.option("-o", "--output", default="benchmark.json", show_default=True, type=click.Path())
+def run(repo_dir, repo_path, repo_port, registry_port, base_image, include_agent, runs, output):
+    """
+    Builds images against local registry and repository, records timings to json file.
+    """
+    from ambari_docker import image_builder
+    from ambari_docker.metrics import METRICS
+
+    docker_client = image_builder.get_docker_client()
+    repository = f"http://{image_builder.get_bridge_gateway()}:{repo_port}/{repo_path.strip('/')}"
+
+    results = []
+    with RepoServer(repo_dir, repo_port), LocalRegistry(docker_client, registry_port) as registry:
+        registry_base_image = registry.publish(base_image)
+        for run_number in range(runs):
+            LOG.info(f"Benchmark run {run_number + 1}/{runs}")
+            try:
+                docker_client.images.remove(registry_base_image)
+            except Exception:
+                pass
+            results.append(_run_once(image_builder, METRICS, repository, registry_base_image, include_agent))
+
+    report = {
+        "created": time.time(),
+        "host": platform.node(),
+        "repository": repository,
+        "runs": results,
+        "median": {
+            "total": statistics.median(result["total"] for result in results),
+            "stages": {
+                stage: statistics.median(result["stages"].get(stage, 0) for result in results)
+                for stage in results[0]["stages"]
+            }
+        }
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    LOG.info(f"Benchmark report written to '{output}'")
+
+
+@cli.command()
+@click.argument("baseline", type=click.File())
+@click.argument("current", type=click.File())
+@click.option("--threshold", default=10.0, show_default=True, type=click.FLOAT,
+              help="allowed slowdown in percents")
+@click.option("--min-seconds", default=1.0, show_default=True, type=click.FLOAT,
+              help="stages faster than this in both reports are not compared")
+def compare(baseline, current, threshold, min_seconds):
+    """
+    Compares two benchmark reports, exits with non-zero code on regression.
+    """
+    baseline_median = json.load(baseline)["median"]
+    current_median = json.load(current)["median"]
+
+    rows = [("total", baseline_median["total"], current_median["total"])]
+    for stage in sorted(set(baseline_median["stages"]) | set(current_median["stages"])):
+        rows.append((stage, baseline_median["stages"].get(stage, 0), current_median["stages"].get(stage, 0)))
+
+    regressions = []
+    click.echo(f"{'stage':<60} {'baseline':>10} {'current':>10} {'change':>8}")
+    for stage, before, after in rows:
+        change = (after - before) / before * 100 if before else 0.0
+        click.echo(f"{stage:<60} {before:>10.2f} {after:>10.2f} {change:>7.1f}%")
+        if max(before, after) >= min_seconds and change > threshold:
+            regressions.append(stage)
+
+    if regressions:
+        click.echo(f"Regressions above {threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Guard for cli startup latency.
+
+Imports cli module in fresh interpreters, reports median import time and fails if it exceeds threshold or if modules
+that must be loaded lazily (docker client, requests, image builder) are imported at startup.
+
+Example:
+    python benchmarks/import_time.py --max-ms 150
+"""
+import json
+import statistics
+import subprocess
+import sys
+
+import click
+
+CLI_MODULE = "ambari_docker.cli.ambari_docker_cli"
+
+# modules needed only by commands that build images
+LAZY_MODULES = (
+    "docker",
+    "requests",
+    "ambari_docker.image_builder",
+    "ambari_docker.downloads",
+    "ambari_docker.repositories",
+    "ambari_docker.yum_proxy"
+)
+
+_PROBE = f"""
+import json, sys, time
+started = time.perf_counter()
+import {CLI_MODULE}
+elapsed = time.perf_counter() - started
+print(json.dumps({{"seconds": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def _measure():
+    output = subprocess.check_output([sys.executable, "-c", _PROBE])
+    return json.loads(output)
+
+
+def _slowest_imports(count):
+    """
+    Returns *count* modules with the biggest cumulative import time from '-X importtime' report.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {CLI_MODULE}"],
+        stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True, check=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+@click.command()
+@click.option("--runs", default=5, show_default=True, type=click.IntRange(min=1))
+@click.option("--max-ms", default=150.0, show_default=True, type=click.FLOAT,
+              help="allowed median import time in milliseconds")
+@click.option("--top", default=10, show_default=True, type=click.IntRange(min=0),
+              help="print this many slowest imports")
+def cli(runs, max_ms, top):
+    """
+    Measures cli import time, exits with non-zero code on regression.
+    """
+    measurements = [_measure() for _ in range(runs)]
+    median_ms = statistics.median(m["seconds"] for m in measurements) * 1000
+    click.echo(f"median import time of '{CLI_MODULE}': {median_ms:.1f} ms over {runs} runs")
+
+    for cumulative, name in _slowest_imports(top):
+        click.echo(f"  {cumulative / 1000:>8.1f} ms  {name}")
+
+    failures = []
+    eager_modules = [
+        module for module in LAZY_MODULES
+        if any(loaded == module or loaded.startswith(f"{module}.") for loaded in measurements[0]["modules"])
+    ]
+    if eager_modules:
+        failures.append(f"modules imported at startup: {', '.join(eager_modules)}")
+    if median_ms > max_ms:
+        failures.append(f"import time {median_ms:.1f} ms exceeds {max_ms:.1f} ms")
+
+    if failures:
+        for failure in failures:
+            click.echo(failure)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
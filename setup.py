@@ -1,13 +1,36 @@
 #!/usr/bin/env python
 
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 
+import sys
 from os import path
 
 here = path.abspath(path.dirname(__file__))
 with open(path.join(here, 'README.md'), encoding='utf-8') as f:
     long_description = f.read()
 
+
+class BuildPyWithTemplates(build_py):
+    """
+    Precompiles packaged jinja templates, so installed cli does not parse them on every run.
+    """
+
+    def run(self):
+        super().run()
+        # isolated builds do not have source directory on path, package is imported from build directory
+        sys.path.insert(0, self.build_lib)
+        try:
+            from ambari_docker.config import TemplateTool
+        except ImportError as e:
+            # jinja2 is declared as build requirement in pyproject.toml, missing only in non-isolated builds
+            self.warn(f"templates are not precompiled and will be compiled at runtime: {e}")
+            return
+        finally:
+            sys.path.remove(self.build_lib)
+        target_dir = path.join(self.build_lib, 'ambari_docker', 'data', '_compiled_templates')
+        TemplateTool(bytecode_cache_dir=None).precompile(target_dir)
+
 setup(
     name='ambari-docker-utils',
     version='0.1',
@@ -20,6 +43,7 @@ setup(
     install_requires=['docker', 'jinja2', 'click', 'requests'],
     include_package_data=True,
     zip_safe=False,
+    cmdclass={'build_py': BuildPyWithTemplates},
     entry_points={
         'console_scripts': [
             'ambari-docker = ambari_docker.cli.ambari_docker_cli:cli'